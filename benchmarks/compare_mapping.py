@@ -0,0 +1,71 @@
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Times DatabaseTable.compare_mapping on wide tables, with their definitions in a temporary
+folder and their mapping table in a SQLite database. Run from the repository root:
+python -m benchmarks.compare_mapping [columns ...]'''
+import json
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import MetaData
+
+import settings
+from database.database_table import DatabaseTable
+
+
+def benchmark(columns, repetitions=5):
+    '''
+    Returns the best time of compare_mapping for a table with columns columns, one of them
+    new, one dropped and a tenth of them with a different type
+    '''
+    with tempfile.TemporaryDirectory() as folder:
+        settings.TABLE_DEFINITIONS_FOLDER = folder
+        definitions = {
+            'pairing_description': '', 'data_source': '', 'pk': [], 'foreign_keys': [],
+            'columns': {'c{}'.format(i): ['INT', 'T{}'.format(i)] for i in range(columns)}
+        }
+        with open(os.path.join(folder, 'benchmark.json'), 'w') as definitions_file:
+            json.dump(definitions, definitions_file)
+
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(folder, 'benchmark.db'))
+        table = DatabaseTable('benchmark', MetaData(bind=engine))
+        table._mapping_table.create(bind=engine)
+        engine.execute(table._mapping_table.insert(), [
+            {'target_name': 'T{}'.format(i), 'name': 'c{}'.format(i),
+             'type': 'SMALLINT' if i % 10 == 0 else 'INTEGER'} for i in range(1, columns + 1)
+        ])
+        table.gen_definitions()
+
+        best = None
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            table.compare_mapping()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        engine.dispose()
+    return best
+
+if __name__ == '__main__':
+    for columns in [int(arg) for arg in sys.argv[1:]] or [1000, 3000, 10000]:
+        print('{:>6} columns: {:.4f}s'.format(columns, benchmark(columns)))
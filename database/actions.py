@@ -19,12 +19,20 @@ along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 '''Database manipulation actions - these can be used as models for other modules.'''
+import csv
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sqlalchemy import create_engine, MetaData, text
-from os import chdir
+from sqlalchemy.exc import DBAPIError
+from os import chdir, path
 from datetime import datetime
-from database.base import MissingTableError
+from database.base import DatabaseError, MissingTableError
 from database.database_table import gen_data_table, copy_tabbed_to_csv
+from database import tabbed
+from database.uploads import get_uploader
+from database.streams import open_input, sample_lines
+from database.types import infer_type, fits_type
 import database.groups
 import settings
 from database.groups import DATA_GROUP, DATABASE_TABLE_NAME
@@ -35,6 +43,7 @@ META = MetaData(bind=ENGINE)
 
 logging.basicConfig(format = settings.LOGGING_FORMAT)
 logger = logging.getLogger(__name__)
+logger.setLevel(settings.LOGGING_LEVEL)
 
 database_table_logger = logging.getLogger('database.database_table')
 database_table_logger.setLevel(settings.LOGGING_LEVEL)
@@ -43,31 +52,230 @@ protocol_logger.setLevel(settings.LOGGING_LEVEL)
 sqlalchemy_logger = logging.getLogger('sqlalchemy.engine')
 sqlalchemy_logger.setLevel(settings.LOGGING_LEVEL)
 
-def temporary_data(connection, file_name, table, year, offset=2,
-                   delimiters=[';', '\\n', '"'], null=''):
-    header = pd.read_csv(file_name, encoding="ISO-8859-9", sep=delimiters[0], nrows=1)
-    header = [h.strip() for h in header.columns.values]
+def sample_column_types(file_name, header, delimiters=[';', '\\n', '"'], null='', offset=2,
+                        rows=settings.TYPE_INFERENCE_ROWS, columns=None):
+    '''
+    Infers the type of each column of a csv file from a sample of its lines. If a columns
+    list is given, only those columns are typed.
+    '''
+    lines = (line.decode('ISO-8859-9') for line in sample_lines(file_name, rows, offset - 1))
+    records = [record for record in csv.reader(lines, delimiter=delimiters[0],
+                                               quotechar=delimiters[2])
+               if len(record) == len(header)]
+    if not records:
+        return {}
+    return {column: infer_type(values, null) for column, values in zip(header, zip(*records))
+            if columns is None or column in columns}
+
+def find_type_mismatch(file_name, header, column_types, delimiters=[';', '\\n', '"'], null='',
+                       offset=2):
+    '''
+    Returns the first value of a csv file that doesn't fit the type given to its column in
+    column_types, as a (line number, column, value) tuple, or None if every value fits.
+    '''
+    with open_input(file_name) as input_file:
+        lines = (line.decode('ISO-8859-9') for line in input_file)
+        reader = csv.reader(lines, delimiter=delimiters[0], quotechar=delimiters[2])
+        for line_number, record in enumerate(reader, 1):
+            if line_number < offset:
+                continue
+            for column, value in zip(header, record):
+                if column in column_types and not fits_type(value, column_types[column], null):
+                    return line_number, column, value
+    return None
 
-    ttable = table.get_temporary(header, year)
+def temporary_data(connection, file_name, table, year, offset=2,
+                   delimiters=[';', '\\n', '"'], null='', header=None, client=False, workers=1,
+                   derivatives=True, prune=False, sample_rows=settings.TYPE_INFERENCE_ROWS):
+    '''
+    Creates a temporary table for table and populates it with file_name. Derivatives are
+    applied unless derivatives is False, in which case they must be computed by the insert
+    from the temporary table. If prune is set, columns of the file that are neither mapped
+    nor used by derivatives are not loaded. Types of unmapped columns used by derivatives are
+    inferred from sample_rows lines of the file; if it is 0 they are loaded as VARCHAR(255).
+    If a value of the file doesn't fit the type inferred for its column, a DatabaseError
+    naming the column is raised.
+    '''
+    if header is None:
+        with open_input(file_name) as input_file:
+            header = pd.read_csv(input_file, encoding="ISO-8859-9", sep=delimiters[0], nrows=1)
+        header = [h.strip() for h in header.columns.values]
+
+    column_types = None
+    if sample_rows:
+        plan = table.get_protocol().year_plan(year)
+        referenced = plan.get_unmapped([c for c in header if c in plan.referenced])
+        if referenced:
+            column_types = sample_column_types(file_name, header, delimiters, null, offset,
+                                               sample_rows, referenced)
+
+    ttable = table.get_temporary(header, year, prune=prune, column_types=column_types)
     ttable.create(bind=connection)
-
-    table.populate_temporary(ttable, file_name, header, year, delimiters, null, offset, bind=connection)
-    table.apply_derivatives(ttable, ttable.columns.keys(), year, bind=connection)
+    try:
+        table.populate_temporary(ttable, file_name, header, year, delimiters, null, offset,
+                                 bind=connection, client=client, workers=workers)
+    except DBAPIError as error:
+        # The sample may miss values of the rest of the file. The failed COPY aborts the
+        # transaction, so the load can't be retried as text and the column is reported
+        if not column_types:
+            raise
+        mismatch = find_type_mismatch(file_name, header, column_types, delimiters, null, offset)
+        if mismatch is None:
+            raise
+        line_number, column, value = mismatch
+        raise DatabaseError('Value {!r} of column {} at line {} of {} is not a {}, the type '
+                            'inferred from a sample of the file. Raise TYPE_INFERENCE_ROWS or '
+                            'set it to 0 to load it as text'.format(
+                                value, column, line_number, file_name,
+                                column_types[column])) from error
+
+    if derivatives:
+        ttable = table.apply_derivatives(ttable, ttable.columns.keys(), year, bind=connection)
 
     return ttable
 
-def insert(file_name, table, year, offset=2, delimiters=[';', '\\n', '"'], null='', notifybackup=None):
-    '''Inserts contents of csv in file_name in table using year as index for mapping'''
+def insert(file_name, table, year, offset=2, delimiters=[';', '\\n', '"'], null='', notifybackup=None,
+           client=False, workers=1, prune=False, on_conflict=None):
+    '''Inserts contents of csv in file_name in table using year as index for mapping.
+    If client is set, the file is sent through the connection instead of read by the server.
+    If workers is greater than 1, the file is split and copied by that many connections.
+    If prune is set, unused columns of the file are skipped.
+    on_conflict sets how rows already in the table are handled: skip, update or replace'''
+    table = gen_data_table(table, META)
+    table.map_from_database()
+    if not table.exists():
+        raise MissingTableError(table.name)
+
+    with ENGINE.connect() as connection:
+        trans = connection.begin()
+
+        ttable = temporary_data(connection, file_name, table, year, offset, delimiters, null,
+                                client=client, workers=workers, derivatives=False, prune=prune)
+        table.insert_from_temporary(ttable, bind=connection, year=year, on_conflict=on_conflict)
+
+        trans.commit()
+
+def replace_year(file_name, table, year, offset=2, delimiters=[';', '\\n', '"'], null='',
+                 client=False, workers=1, prune=False):
+    '''Replaces the rows of a year of table with the contents of csv in file_name.
+    The file is loaded into a temporary table before the rows of the year are deleted, and
+    both the delete and the insert run in a single transaction'''
     table = gen_data_table(table, META)
     table.map_from_database()
     if not table.exists():
         raise MissingTableError(table.name)
 
+    start = time.time()
     with ENGINE.connect() as connection:
         trans = connection.begin()
 
-        ttable = temporary_data(connection, file_name, table, year, offset, delimiters, null)
-        table.insert_from_temporary(ttable, bind=connection)
+        ttable = temporary_data(connection, file_name, table, year, offset, delimiters, null,
+                                client=client, workers=workers, derivatives=False, prune=prune)
+        table.delete_year(year, bind=connection)
+        rows = table.insert_from_temporary(ttable, bind=connection, year=year)
+
+        trans.commit()
+    logger.info("Replaced %s of %s with %d rows in %.1fs", year, table.name, rows,
+                time.time() - start)
+
+def read_manifest(manifest_file):
+    '''
+    Reads a manifest with one "file;year" pair per line. Empty lines and lines starting
+    with # are ignored, and relative paths are taken from the directory of the manifest.
+    '''
+    directory = path.dirname(path.abspath(manifest_file))
+    entries = []
+    with open(manifest_file) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            file_name, year = [field.strip() for field in line.rsplit(';', 1)]
+            entries.append((path.join(directory, file_name), year))
+    return entries
+
+def insert_many(manifest_file, table, workers=4, offset=2, delimiters=[';', '\\n', '"'], null='',
+                client=False, prune=False, on_conflict=None):
+    '''
+    Inserts the files listed in a manifest of "file;year" lines in table. Files are loaded
+    concurrently by up to workers connections, each one with its own temporary table, while
+    the table mapping and the protocol are shared. If prune is set, unused columns of the
+    files are skipped. on_conflict is used as in insert.
+    '''
+    entries = read_manifest(manifest_file)
+    table = gen_data_table(table, META)
+    table.map_from_database()
+    if not table.exists():
+        raise MissingTableError(table.name)
+    # Workers only read the plans and graphs, which are shared by loads of the same year
+    table.prepare_years(list(dict.fromkeys(year for _, year in entries)))
+
+    def load(file_name, year):
+        '''Loads a single file, returning the number of rows inserted'''
+        start = time.time()
+        with ENGINE.connect() as connection:
+            trans = connection.begin()
+
+            ttable = temporary_data(connection, file_name, table, year, offset, delimiters,
+                                    null, client=client, derivatives=False, prune=prune)
+            rows = table.insert_from_temporary(ttable, bind=connection, year=year,
+                                               on_conflict=on_conflict)
+
+            trans.commit()
+
+        elapsed = time.time() - start
+        size = path.getsize(file_name) / 2**20
+        logger.info("Loaded %s (%s): %d rows, %.1f MB in %.1fs (%.1f MB/s, %.0f rows/s)",
+                    file_name, year, rows, size, elapsed, size / max(elapsed, 1e-3),
+                    rows / max(elapsed, 1e-3))
+        return rows
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(load, file_name, year): (file_name, year)
+                   for file_name, year in entries}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                logger.error("Failed to load %s (%s): %s", *futures[future], future.exception())
+                failed.append(futures[future])
+
+    if failed:
+        raise DatabaseError('Failed to load {}'.format(', '.join(f for f, _ in failed)))
+
+def insert_tabbed(file_name, table, year, sep=';', null='', workers=1, client=False):
+    '''
+    Inserts contents of the tabbed file file_name in table using year as index for mapping.
+    Records are decoded with the positions from the protocol and streamed into the temporary
+    table without writing an intermediate csv: through a named pipe read by the server or,
+    if client is set, through the connection.
+    '''
+    table = gen_data_table(table, META)
+    table.map_from_database()
+    if not table.exists():
+        raise MissingTableError(table.name)
+
+    header, column_mappings = table.get_protocol().get_tabbed_mapping(year)
+    delimiters = [sep, '\\n', '"']
+
+    with ENGINE.connect() as connection:
+        trans = connection.begin()
+
+        if client:
+            if workers > 1:
+                chunks = tabbed.iterate_csv_parallel(file_name, column_mappings,
+                                                     settings.CHUNK_SIZE, workers, sep)
+            else:
+                chunks = tabbed.iterate_csv(file_name, column_mappings, settings.CHUNK_SIZE, sep)
+            get_uploader(connection).add_file(file_name, chunks)
+            ttable = temporary_data(connection, file_name, table, year, 1, delimiters, null,
+                                    header=header, client=True, derivatives=False,
+                                    sample_rows=0)
+        else:
+            with tabbed.csv_fifo(file_name, column_mappings, settings.CHUNK_SIZE, sep,
+                                 workers) as fifo_name:
+                ttable = temporary_data(connection, fifo_name, table, year, 1, delimiters, null,
+                                        header=header, derivatives=False, sample_rows=0)
+        table.insert_from_temporary(ttable, bind=connection, year=year)
 
         trans.commit()
 
@@ -89,26 +297,35 @@ def drop(table):
 
     table.drop()
 
-def remap(table, auto_confirmation=True, verify_definitions=False):
-    '''Applies change made in mapping protocols to database'''
+def remap(table, auto_confirmation=True, verify_definitions=False, strategy='auto',
+          online=False, workers=1, batch_size=settings.REMAP_BATCH_SIZE, resume=False):
+    '''Applies change made in mapping protocols to database.
+    If online is set, the table is remapped in a shadow table, copied by workers connections,
+    which replaces it at the end. Otherwise, changed columns are transferred in batches of
+    batch_size rows, and resume finishes an interrupted transfer'''
     table = gen_data_table(table, META)
     table.gen_definitions()
     table.map_from_database()
 
-    table.remap(auto_confirmation, verify_definitions)
+    table.remap(auto_confirmation, verify_definitions, strategy, online, workers, batch_size,
+                resume)
 
-def csv_from_tabbed(table_name, input_file, output_file, year, sep=';'):
+def csv_from_tabbed(table_name, input_file, output_file, year, sep=';', workers=1):
     table = gen_data_table(table_name, META)
 
     protocol = table.get_protocol()
     column_names, column_mappings = protocol.get_tabbed_mapping(year)
 
     copy_tabbed_to_csv(input_file, column_mappings, settings.CHUNK_SIZE, output_file,
-                       column_names=column_names, sep=sep)
+                       column_names=column_names, sep=sep, workers=workers)
 
 def update_from_file(file_name, table, year, columns=None,
-                     offset=2, delimiters=[';', '\\n', '"'], null=''):
-    '''Updates table columns from an input csv file'''
+                     offset=2, delimiters=[';', '\\n', '"'], null='', client=False, workers=1,
+                     prune=False):
+    '''Updates table columns from an input csv file.
+    If client is set, the file is sent through the connection instead of read by the server.
+    If workers is greater than 1, the file is split and copied by that many connections.
+    If prune is set, unused columns of the file are skipped'''
     table = gen_data_table(table, META)
     table.map_from_database()
     if not table.exists():
@@ -120,8 +337,10 @@ def update_from_file(file_name, table, year, columns=None,
     with ENGINE.connect() as connection:
         trans = connection.begin()
 
-        ttable = temporary_data(connection, file_name, table, year, offset, delimiters, null)
-        table.update_from_temporary(ttable, columns, bind=connection)
+        ttable = temporary_data(connection, file_name, table, year, offset, delimiters, null,
+                                client=client, workers=workers, prune=prune)
+        rows, cells = table.update_from_temporary(ttable, columns, bind=connection, year=year)
+        logger.info("%d cells changed in %d rows of %s", cells, rows, table.name)
 
         trans.commit()
 
@@ -139,6 +358,14 @@ def run_aggregations(table, year):
 
         trans.commit()
 
+def explain_derivatives(table, year):
+    '''
+    Prints the derivatives and denormalizations of a year, ordered by the UPDATE pass which
+    computes them
+    '''
+    table = gen_data_table(table, META)
+    print(table.get_derivative_graph(year).explain())
+
 def generate_backup():
     '''Create/Recriate file monitored by backup script in production'''
     chdir(settings.BACKUP_FOLDER)
@@ -24,18 +24,24 @@ import time
 import json
 import re
 import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 import jsbeautifier
-from sqlalchemy import Table, Column, inspect, Integer, String, Boolean,\
+from sqlalchemy import Table, Column, MetaData, inspect, Integer, String, Boolean, Text,\
                        PrimaryKeyConstraint, ForeignKeyConstraint, text
-from sqlalchemy.sql import select, insert, update, delete, func
-import pandas as pd
+from sqlalchemy.schema import AddConstraint
+from sqlalchemy.sql import select, insert, update, delete, func, and_, or_, case, exists, \
+    literal_column, cast, null, true
 
 from database.base import DatabaseColumnError, MissingProtocolError, DatabaseMappingError, \
     InvalidTargetError, MissingForeignKeyError, MissingTableError, \
-    CircularReferenceError, MissingDefinitionsError
-from database.protocol import Protocol
+    CircularReferenceError, MissingDefinitionsError, DatabaseError
+from database.protocol import Protocol, DENORMALIZATION_RE
+from database import streams, tabbed, uploads
 from database.types import get_type
 from database.definitions import Definitions
+from database.derivatives import DerivativeGraph, GRAPH_CACHE
 import settings
 
 # Disable no-member warnings to silence false positives from Table instances dinamically generated
@@ -44,6 +50,12 @@ import settings
 
 logger = logging.getLogger(__name__)
 
+# Suffixes of temporary table names
+TEMPORARY_COUNTER = itertools.count()
+
+# Ways to handle rows of a temporary table whose primary key is already in the table
+ON_CONFLICT_MODES = ['skip', 'update', 'replace']
+
 def gen_source_table(meta):
     '''Returns a source table object, so source entries can be added or updated'''
     logger.info("Acquiring source table")
@@ -70,49 +82,67 @@ def gen_mapping_table(table):
 
     return mapping_table
 
+def gen_checkpoint_table(meta):
+    '''Returns the table where the progress of batched remap transfers is recorded'''
+    checkpoint_table = Table(settings.REMAP_CHECKPOINT_TABLE, meta,
+                             Column('table_name', String(63), primary_key=True),
+                             Column('stage', String(15)),
+                             Column('transfers', Text),
+                             Column('last_key', Text),
+                             Column('transferred', Integer),
+                             extend_existing=True)
+
+    return checkpoint_table
+
+def keys_after(pks, values):
+    '''
+    Returns a condition selecting rows whose primary key columns pks come after values, in
+    the order given by pks. If values is None, every row is selected.
+    '''
+    if values is None:
+        return true()
+    conditions = []
+    for i, pk in enumerate(pks):
+        conditions.append(and_(*[p == v for p, v in zip(pks[:i], values)], pk > values[i]))
+    return or_(*conditions)
+
 def get_primary_keys(table):
     '''Returns a list of columns corresponding to the primary key of a given table instance'''
     return [c[1] for c in table.primary_key.columns.items()]
 
-def tabbed_iterate(tabbed_file_name, column_mappings, chunk_size):
+def tabbed_iterate(tabbed_file_name, column_mappings, chunk_size, encoding=tabbed.ENCODING):
     '''
     Iterates over a tabbed file and yields chunks of chunk_size
     '''
-    counter = 0
-    chunk = []
-
-    tabbed_file = open(tabbed_file_name)
-    for line in tabbed_file:
-        line = list(line)
-        entry = [''.join(line[int(p0-1):int(p0+pt-1)]).strip().strip('.') for p0, pt in column_mappings]
-        chunk.append(tuple(entry))
-        counter += 1
-        if counter == chunk_size:
-            yield chunk
-            chunk = []
-            counter = 0
-    if chunk:
-        yield chunk
-    tabbed_file.close()
+    for columns in tabbed.iterate_columns(tabbed_file_name, column_mappings, chunk_size):
+        columns = [[value.decode(encoding) for value in column] for column in columns]
+        yield list(zip(*columns))
 
 def copy_tabbed_to_csv(tabbed_file_name, column_mappings, chunk_size, output_file_name,
-                       column_names=None, sep=';'):
+                       column_names=None, sep=';', workers=1):
     '''
-    Copies tabbed positional data into csv
+    Copies tabbed positional data into csv. Values are copied byte by byte, so the csv keeps
+    the encoding of the tabbed file. If workers > 1, the file is converted by that many
+    processes, keeping the order of its records.
     '''
-    output_file = open(output_file_name, 'w')
     if column_names:
         if not len(column_names) == len(column_mappings):
             print('column_names != column_mappings')
             # Raise an exception here?
             return
-        header = sep.join(column_names)
-        output_file.write(header + '\n')
 
-    for chunk in tabbed_iterate(tabbed_file_name, column_mappings, chunk_size):
-        chunk = pd.DataFrame(chunk)
+    with open(output_file_name, 'wb') as output_file:
+        if column_names:
+            header = sep.join(column_names)
+            output_file.write(header.encode() + b'\n')
 
-        chunk.to_csv(output_file, header=False, index=False, sep=sep)
+        if workers > 1:
+            chunks = tabbed.iterate_csv_parallel(tabbed_file_name, column_mappings, chunk_size,
+                                                 workers, sep)
+        else:
+            chunks = tabbed.iterate_csv(tabbed_file_name, column_mappings, chunk_size, sep)
+        for chunk in chunks:
+            output_file.write(chunk)
 
 def is_aggregation(in_string):
     '''
@@ -152,11 +182,13 @@ class DatabaseTable(Table):
         if 'protocol' in kwargs.keys():
             self.load_protocol(kwargs['protocol'])
 
-    def get_temporary(self, header_columns=[], year=None):
+    def get_temporary(self, header_columns=[], year=None, prune=False, column_types=None):
         '''
         Returns a temporary table with identical structure to self. If a header_columns list
         is passed, will check protocol to ensure any of the columns is not mapped. Unmapped
-        columns will be added with original name and type VARCHAR(255).
+        columns will be added with original name and the type string given for them in the
+        column_types dictionary, or VARCHAR(255). If prune is set, unmapped columns are only
+        added when derivatives reference them.
 
         If a header_columns list is provided, a year must be passed to allow mapping to originals.
         '''
@@ -165,27 +197,30 @@ class DatabaseTable(Table):
 
         additional = header_columns.copy()
         if year:
-            for column in header_columns:
-                target = self._protocol.target_from_original(column, year)
+            plan = self._protocol.year_plan(year)
+            if prune:
+                additional = plan.get_unmapped(plan.get_used(header_columns))
+            else:
+                additional = plan.get_unmapped(header_columns)
+            table_columns = plan.table_columns
+        else:
+            table_columns = []
+            for target in self._protocol.get_targets():
                 try:
-                    if target and self._protocol.dbcolumn_from_target(target):
-                        additional.remove(column)
+                    table_columns.append(self._protocol.dbcolumn_from_target(target))
                 except InvalidTargetError:
                     pass
 
+        # The counter keeps names unique when several files are loaded at the same time
         timestamp = time.strftime('%Y%m%d%H%M%S')
-        name = '_' + timestamp + '_' + self.name
+        name = '_' + timestamp + '_' + str(next(TEMPORARY_COUNTER)) + '_' + self.name
 
         logger.info("Acquiring temporary table with name '%s'", name)
         logger.debug("Temporary table '%s' with list of extra columns %s", name, header_columns)
         ttable = Table(name, self.metadata, prefixes=['TEMPORARY'], schema='tmp')
 
-        for target in self._protocol.get_targets():
-            try:
-                column_name, column_type = self._protocol.dbcolumn_from_target(target)
-                ttable.append_column(Column(column_name, get_type(column_type)))
-            except InvalidTargetError:
-                pass
+        for column_name, column_type in table_columns:
+            ttable.append_column(Column(column_name, get_type(column_type)))
 
         pks = get_primary_keys(self)
         primary_key = []
@@ -194,40 +229,132 @@ class DatabaseTable(Table):
 
         ttable.constraints.add(PrimaryKeyConstraint(*primary_key))
 
+        column_types = column_types or {}
         for column in additional:
-            ttable.append_column(Column(column, String(255)))
+            if column in column_types:
+                ttable.append_column(Column(column, get_type(column_types[column])))
+            else:
+                ttable.append_column(Column(column, String(255)))
 
         return ttable
 
     def populate_temporary(self, ttable, in_file, header, year, delimiters=[';', '\\n', '"'],
-                           null='', offset=2, bind=None):
+                           null='', offset=2, bind=None, client=False, workers=1):
         '''
         Visits a temporary table ttable and bulk inserts data from in_file in it. The header
         list of the original file must be supplied to ensure columns are correctly mapped.
+        If client is set, in_file is sent by the client through the connection instead of
+        being read by the server, and bind must be a connection. Compressed files are
+        decompressed on the fly.
+        If workers is greater than 1, the file is split in that many parts, copied in parallel
+        into staging tables, each one through its own connection. Values must not contain
+        line breaks in this mode. Returns the last executed query.
+        Columns of the file missing from ttable, as created by get_temporary with prune set,
+        are skipped by the COPY.
         '''
         if bind is None:
             bind = self.metadata.bind
 
-        columns = header.copy()
-        for i, column in enumerate(columns):
-            try:
-                target = self._protocol.target_from_original(column, year)
-                columns[i] = self._protocol.dbcolumn_from_target(target)[0] or column
-            except InvalidTargetError:
-                pass
+        file_columns = self._protocol.year_plan(year).get_dbcolumns(header)
+        columns = [c for c in file_columns if ttable.columns.get(c) is not None]
+        if len(columns) < len(file_columns):
+            logger.info("Skipping %d unused columns of %s", len(file_columns) - len(columns),
+                        in_file)
+
+        if workers > 1 and not streams.is_compressed(in_file):
+            return self._populate_parallel(ttable, in_file, columns, file_columns, delimiters,
+                                           null, offset, bind, client, workers)
 
-        columns = ['"{}"'.format(c) for c in columns]
+        chunks = None
+        if streams.is_compressed(in_file):
+            chunks = streams.iterate_input(in_file)
+        return self._copy_from(ttable.name, columns, file_columns, in_file, chunks, delimiters,
+                               null, offset, bind, client)
+
+    def _copy_from(self, table_name, columns, file_columns, in_file, chunks, delimiters, null,
+                   offset, bind, client):
+        '''
+        Runs a COPY of in_file, whose fields are file_columns, into columns of table
+        table_name. Fields not in columns are skipped. If chunks, an iterable of bytes, is
+        given, the data is taken from it instead of from the file.
+        '''
         delimiters = ["'{}'".format(d) for d in delimiters]
         delimiters = ', '.join(delimiters)
-        query_columns = ', '.join(columns)
-        query = 'COPY OFFSET {} INTO {}({}) '.format(offset, ttable.name, query_columns)
-        query = query + "FROM '{}'({}) USING DELIMITERS {} ".format(in_file, query_columns,
-                                                                    delimiters)
-        query = query + "NULL AS '{}'".format(null)
+        query_columns = ', '.join('"{}"'.format(c) for c in columns)
+        query_file_columns = ', '.join('"{}"'.format(c) for c in file_columns)
+
+        with ExitStack() as stack:
+            source = in_file
+            if client:
+                uploads.get_uploader(bind).add_file(in_file, chunks)
+            elif chunks is not None:
+                # The server reads the data from a named pipe
+                name = os.path.basename(in_file)
+                if streams.is_compressed(in_file):
+                    name = os.path.splitext(name)[0]
+                source = stack.enter_context(streams.fifo(chunks, name))
+
+            query = 'COPY OFFSET {} INTO {}({}) '.format(offset, table_name, query_columns)
+            query = query + "FROM '{}'({}) ".format(source, query_file_columns)
+            if client:
+                query = query + "ON CLIENT "
+            query = query + "USING DELIMITERS {} ".format(delimiters)
+            query = query + "NULL AS '{}'".format(null)
+
+            query = text(query)
 
-        query = text(query)
+            bind.execute(query)
 
-        bind.execute(query)
+        return query
+
+    def _populate_parallel(self, ttable, in_file, columns, file_columns, delimiters, null,
+                           offset, bind, client, workers):
+        '''
+        Splits in_file in workers byte ranges aligned to lines and copies each one into a
+        staging table through its own connection. Staging tables are then transferred to
+        ttable in the order of the file, and dropped.
+        '''
+        engine = self.metadata.bind
+        start = streams.position_after_lines(in_file, offset - 1)
+        size = os.path.getsize(in_file) - start
+        ranges = streams.split_ranges(in_file, -(-size // workers), start)
+
+        staging_tables = []
+        for i in range(len(ranges)):
+            name = '{}_{}'.format(ttable.name, i)
+            staging = Table(name, MetaData(), *[Column(c, ttable.columns.get(c).type)
+                                                for c in columns])
+            staging_tables.append(staging)
+
+        def copy_range(staging, start, end):
+            '''Copies a byte range of in_file into a staging table'''
+            with engine.connect() as connection:
+                trans = connection.begin()
+                staging.create(bind=connection)
+                self._copy_from(staging.name, columns, file_columns, in_file,
+                                streams.iterate_range(in_file, start, end), delimiters, null, 1,
+                                connection, client)
+                trans.commit()
+
+        logger.info("Copying %s in %d parts", in_file, len(ranges))
+        query = None
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(copy_range, staging, start, end)
+                           for staging, (start, end) in zip(staging_tables, ranges)]
+                for future in futures:
+                    future.result()
+
+            temp_schema = ttable.schema
+            ttable.schema = None
+            target = [ttable.columns.get(c) for c in columns]
+            for staging in staging_tables:
+                query = ttable.insert().from_select(target, select(list(staging.columns)))
+                bind.execute(query)
+            ttable.schema = temp_schema
+        finally:
+            for staging in staging_tables:
+                staging.drop(bind=engine, checkfirst=True)
 
         return query
 
@@ -366,20 +493,21 @@ class DatabaseTable(Table):
             logger.info("Creating mapping table %s", self._mapping_table.name)
             self._mapping_table.create(bind=bind)
 
-        with bind.connect() as connection:
-            logger.info("Populating mapping table")
-            columns = [c[1] for c in self.columns.items()]
-            for c in columns:
-                column = {}
-                column['target_name'] = self._definitions.columns[c.name][1]
-                if not column['target_name']:
-                    continue
-                column['name'] = c.name
-                column['type'] = str(c.type)
-                logger.debug("Mapping column %s with target_name %s",
-                             column['name'], column['target_name'])
-                query = insert(self._mapping_table).values(**column)
-                connection.execute(query)
+        logger.info("Populating mapping table")
+        entries = []
+        columns = [c[1] for c in self.columns.items()]
+        for c in columns:
+            column = {}
+            column['target_name'] = self._definitions.columns[c.name][1]
+            if not column['target_name']:
+                continue
+            column['name'] = c.name
+            column['type'] = str(c.type)
+            logger.debug("Mapping column %s with target_name %s",
+                         column['name'], column['target_name'])
+            entries.append(column)
+        if entries:
+            bind.execute(insert(self._mapping_table), entries)
 
     def set_source(self, bind=None):
         '''
@@ -492,55 +620,83 @@ class DatabaseTable(Table):
         Drops a column given by name using connection. If no transaction control is necessary,
         and engine can be passed instead of a connection
         '''
+        self.drop_columns([(name, target)], bind=bind)
+
+    def drop_columns(self, columns, bind=None):
+        '''
+        Drops columns given as (name, target) pairs. Targets which are not None are removed
+        from the mapping table with a single query, and the ALTER statements are sent to the
+        database in a single batch.
+        '''
         if bind is None:
             bind = self.metadata.bind
 
-        if target is not None and self._mapping_table.exists():
-            logger.debug("Deleting target %s from %s", target, self._mapping_table.name)
+        targets = [target for _, target in columns if target is not None]
+        if targets and self._mapping_table.exists(bind=bind):
+            logger.debug("Deleting targets %s from %s", targets, self._mapping_table.name)
             query = delete(self._mapping_table)
-            query = query.where(self._mapping_table.c.target_name == target)
+            query = query.where(self._mapping_table.c.target_name.in_(targets))
             bind.execute(query)
-        elif target is None:
-            logger.warning("Dropping column %s without mapping", name)
-        else:
+        elif targets:
             logger.warning("Table %s has no mpaping", self.name)
 
-        column = self.columns.get(name)
-        if column is not None:
-            logger.debug("Dropping column %s from %s", name, self.name)
-            query = "alter table {} drop column {}".format(self.name, name)
-            bind.execute(query)
+        statements = []
+        for name, target in columns:
+            if target is None:
+                logger.warning("Dropping column %s without mapping", name)
+            column = self.columns.get(name)
+            if column is not None:
+                logger.debug("Dropping column %s from %s", name, self.name)
+                statements.append("alter table {} drop column {}".format(self.name, name))
+                # Later changes in the same remap, such as a rebuild, must not see the column
+                self._columns.remove(column)
+        if statements:
+            bind.execute(';\n'.join(statements))
 
     def add_column(self, name, field_type, target=None, bind=None):
         '''
         Adds a column with name and type using connection. If no transaction control is
         necessary, and engine can be passed instead of a connection
         '''
+        self.add_columns([(name, field_type, target)], bind=bind)
+
+    def add_columns(self, columns, bind=None):
+        '''
+        Adds columns given as (name, type, target) tuples. Columns with a target which is not
+        None are mapped with a single multi-row insert in the mapping table, and the ALTER
+        statements are sent to the database in a single batch.
+        '''
         if bind is None:
             bind = self.metadata.bind
 
-        field_type = get_type(field_type)
-
-        if target is not None and self._mapping_table.exists():
-            entry = {
-                'target_name': target,
-                'name': name,
-                'type': str(field_type)
-            }
-            logger.debug("Mapping column %s with type %s. Target: %s", name, str(field_type), target)
-            query = insert(self._mapping_table).values(**entry)
-            bind.execute(query)
-
-        column = self.columns.get(name)
-        if column is None:
-            logger.debug("Adding column %s with type %s", name, str(field_type))
-            column = Column(name, field_type)
-            self.append_column(column)
+        entries = []
+        statements = []
+        for name, field_type, target in columns:
+            field_type = get_type(field_type)
+            if target is not None:
+                logger.debug("Mapping column %s with type %s. Target: %s", name, str(field_type),
+                             target)
+                entries.append({
+                    'target_name': target,
+                    'name': name,
+                    'type': str(field_type)
+                })
+
+            column = self.columns.get(name)
+            if column is None:
+                logger.debug("Adding column %s with type %s", name, str(field_type))
+                column = Column(name, field_type)
+                self.append_column(column)
+
+                statements.append("alter table {} add column {} {}".format(self.name, name,
+                                                                           str(field_type)))
+            else:
+                logger.warning("Column %s already exists. Won't attempt to create.", name)
 
-            query = "alter table {} add column {} {}".format(self.name, name, str(field_type))
-            bind.execute(query)
-        else:
-            logger.warning("Column %s already exists. Won't attempt to create.", name)
+        if entries and self._mapping_table.exists(bind=bind):
+            bind.execute(insert(self._mapping_table), entries)
+        if statements:
+            bind.execute(';\n'.join(statements))
 
     def redefine_column(self, connection, original_name, new_name=None, new_type=None):
         '''
@@ -560,6 +716,13 @@ class DatabaseTable(Table):
         self.drop_column(original_name, bind=connection)
         self.add_column(new_name, new_type, bind=connection)
 
+        self._rename_mapped_column(connection, original_name, new_name, new_type)
+
+    def _rename_mapped_column(self, connection, original_name, new_name, new_type):
+        '''
+        Updates the column object and the mapping table entry of a column that was renamed
+        or retyped in the database.
+        '''
         field_type = get_type(new_type.lower())
 
         self.columns.replace(Column(original_name, field_type, key=new_name))
@@ -620,6 +783,408 @@ class DatabaseTable(Table):
 
         trans.commit()
 
+    def get_transfer_checkpoint(self, bind=None):
+        '''
+        Returns the checkpoint of an unfinished batched transfer of self as a dictionary with
+        its stage, transfers, last_key and transferred rows, or None if there is no such transfer.
+        '''
+        if bind is None:
+            bind = self.metadata.bind
+        checkpoint_table = gen_checkpoint_table(self.metadata)
+        if not checkpoint_table.exists(bind=bind):
+            return None
+
+        query = select([checkpoint_table]).where(checkpoint_table.c.table_name == self.name)
+        row = bind.execute(query).fetchone()
+        if row is None:
+            return None
+        return {
+            'stage': row['stage'],
+            'transfers': json.loads(row['transfers']),
+            'last_key': json.loads(row['last_key']) if row['last_key'] else None,
+            'transferred': row['transferred']
+        }
+
+    def transfer_data_batched(self, transfer_list, batch_size=settings.REMAP_BATCH_SIZE):
+        '''
+        Transfers data like transfer_data, committing every batch_size rows. Rows are copied
+        into a backup table in primary key order, the columns are redefined, and the new
+        columns are filled from the backup. The progress is recorded in the checkpoint table,
+        so an interrupted transfer is finished by resume_transfer.
+        '''
+        if not transfer_list:
+            return
+        if not get_primary_keys(self):
+            logger.error("Cant transfer data for table that has no Primary Key.")
+            return
+        if self.get_transfer_checkpoint() is not None:
+            raise DatabaseError("Table {} has an unfinished transfer".format(self.name))
+
+        checkpoint_table = gen_checkpoint_table(self.metadata)
+        backup = self._get_transfer_backup(transfer_list)
+        with self.metadata.bind.connect() as connection:
+            trans = connection.begin()
+            if not checkpoint_table.exists(bind=connection):
+                checkpoint_table.create(bind=connection)
+            backup.create(bind=connection)
+            connection.execute(insert(checkpoint_table).values(
+                table_name=self.name, stage='backup', transfers=json.dumps(transfer_list),
+                last_key=None, transferred=0))
+            trans.commit()
+
+        self.resume_transfer(batch_size)
+
+    def resume_transfer(self, batch_size=settings.REMAP_BATCH_SIZE):
+        '''
+        Finishes the batched transfer recorded in the checkpoint table for self, from its last
+        committed batch on. Does nothing if there is no such transfer.
+        '''
+        checkpoint = self.get_transfer_checkpoint()
+        if checkpoint is None:
+            logger.info("No transfer of %s to resume", self.name)
+            return
+
+        transfer_list = checkpoint['transfers']
+        backup = self._get_transfer_backup(transfer_list)
+        checkpoint_table = gen_checkpoint_table(self.metadata)
+        engine = self.metadata.bind
+        if checkpoint['stage'] == 'backup':
+            original_columns = []
+            for transfer in transfer_list:
+                if transfer['name'] not in self.columns.keys():
+                    raise DatabaseColumnError(transfer['name'])
+                original_columns.append(self.columns.get(transfer['name']))
+            base_select = select(get_primary_keys(self) + original_columns)
+            self._transfer_batches(
+                self, lambda condition: insert(backup).from_select(list(backup.columns),
+                                                                   base_select.where(condition)),
+                checkpoint, batch_size, 'redefine')
+
+        if checkpoint['stage'] == 'redefine':
+            with engine.connect() as connection:
+                trans = connection.begin()
+                for transfer in transfer_list:
+                    self.redefine_column(connection, transfer['name'],
+                                         transfer['new_name'], transfer['new_type'])
+                self._set_transfer_checkpoint(connection, checkpoint, stage='update')
+                trans.commit()
+
+        if checkpoint['stage'] == 'update':
+            match = and_(*[backup.columns.get(pk.name) == pk for pk in get_primary_keys(self)])
+            values = {}
+            for transfer in transfer_list:
+                column = backup.columns.get(transfer['new_name'])
+                values[transfer['new_name']] = select([column]).where(match).as_scalar()
+            base_update = update(self).values(**values)
+            self._transfer_batches(backup, base_update.where, checkpoint, batch_size, 'clean')
+
+        with engine.connect() as connection:
+            trans = connection.begin()
+            backup.drop(bind=connection, checkfirst=True)
+            connection.execute(delete(checkpoint_table)
+                               .where(checkpoint_table.c.table_name == self.name))
+            trans.commit()
+
+    def _get_transfer_backup(self, transfer_list):
+        '''Returns the table where batched transfers of self keep the transferred columns'''
+        columns = [Column(pk.name, pk.type, primary_key=True) for pk in get_primary_keys(self)]
+        columns += [Column(t['new_name'], get_type(t['new_type'].lower())) for t in transfer_list]
+        return Table(self.name + '_remap', MetaData(), *columns, schema=self.schema)
+
+    def _set_transfer_checkpoint(self, connection, checkpoint, **values):
+        '''Updates checkpoint with values, both in the dictionary and in the checkpoint table'''
+        if 'stage' in values:
+            values.update(last_key=None, transferred=0)
+        checkpoint.update(values)
+
+        checkpoint_table = gen_checkpoint_table(self.metadata)
+        values['last_key'] = json.dumps(values.get('last_key'), default=str)
+        connection.execute(update(checkpoint_table)
+                           .where(checkpoint_table.c.table_name == self.name).values(**values))
+
+    def _transfer_batches(self, key_table, gen_query, checkpoint, batch_size, next_stage):
+        '''
+        Runs the query returned by gen_query(condition) for consecutive ranges of batch_size
+        primary keys of key_table, from checkpoint['last_key'] on, where condition selects the
+        rows of self in the range. Each range is committed along with the checkpoint, which
+        moves to next_stage with the last range. A batch_size of 0 runs a single range.
+        The end of each range is the largest of the next batch_size keys, which are found
+        through the primary key index instead of skipping the keys before them.
+        '''
+        key_pks = get_primary_keys(key_table)
+        pks = [self.columns.get(pk.name) for pk in key_pks]
+        engine = self.metadata.bind
+
+        last_key = checkpoint['last_key']
+        while True:
+            next_key = None
+            if batch_size > 0:
+                batch = select(key_pks).where(keys_after(key_pks, last_key))\
+                        .order_by(*key_pks).limit(batch_size).alias('batch')
+                bound = select(list(batch.columns))\
+                        .order_by(*[c.desc() for c in batch.columns]).limit(1)
+                next_key = engine.execute(bound).fetchone()
+
+            condition = keys_after(pks, last_key)
+            if next_key is not None:
+                next_key = list(next_key)
+                condition = and_(condition, ~keys_after(pks, next_key))
+
+            with engine.connect() as connection:
+                trans = connection.begin()
+                result = connection.execute(gen_query(condition))
+                transferred = checkpoint['transferred'] + result.rowcount
+                logger.info("%d rows of %s transferred", transferred, self.name)
+                if next_key is None:
+                    self._set_transfer_checkpoint(connection, checkpoint, stage=next_stage)
+                else:
+                    self._set_transfer_checkpoint(connection, checkpoint, last_key=next_key,
+                                                  transferred=transferred)
+                trans.commit()
+
+            if next_key is None:
+                return
+            last_key = next_key
+
+    def _get_remapped_table(self, name, transfer_list, columns_to_add=(), columns_to_drop=()):
+        '''
+        Returns a table named name with the structure of self after a remap, along with the
+        projection of self that fills it and its constraints. transfer_list is described in
+        transfer_data, columns_to_add holds (name, type, target) tuples and columns_to_drop
+        (name, target) pairs. Constraints over dropped columns are left out.
+        '''
+        transfers = {transfer['name']: transfer for transfer in transfer_list}
+        dropped = set(column_name for column_name, _ in columns_to_drop)
+
+        columns = []
+        projection = []
+        for column_name, column in self.columns.items():
+            transfer = transfers.get(column_name)
+            if column_name in dropped:
+                continue
+            elif transfer is None:
+                columns.append(Column(column_name, column.type))
+                projection.append(column)
+            else:
+                field_type = get_type(transfer['new_type'].lower())
+                columns.append(Column(transfer['new_name'], field_type))
+                projection.append(cast(column, field_type).label(transfer['new_name']))
+        for column_name, field_type, _ in columns_to_add:
+            field_type = get_type(field_type)
+            columns.append(Column(column_name, field_type))
+            projection.append(cast(null(), field_type).label(column_name))
+        table = Table(name, MetaData(), *columns, schema=self.schema)
+
+        def get_columns(columns):
+            '''Returns the columns of table corresponding to columns of self'''
+            return [table.columns.get(transfers[c.name]['new_name'] if c.name in transfers
+                                      else c.name) for c in columns]
+
+        constraints = []
+        if self.primary_key.columns and not dropped & set(self.primary_key.columns.keys()):
+            constraints.append(PrimaryKeyConstraint(*get_columns(self.primary_key.columns)))
+        for foreign_key in self.foreign_key_constraints:
+            if not dropped & set(c.name for c in foreign_key.columns):
+                constraints.append(ForeignKeyConstraint(get_columns(foreign_key.columns),
+                                                        [e.column for e in foreign_key.elements]))
+        for constraint in constraints:
+            table.append_constraint(constraint)
+
+        return table, projection, constraints
+
+    def rebuild(self, connection, transfer_list):
+        '''
+        Applies a transfer_list, as described in transfer_data, by building a new table with
+        every column renamed and cast in a single CREATE TABLE ... AS SELECT. Self is then
+        dropped, the new table takes its name and the primary and foreign keys of self are
+        recreated. Other objects are lost, so tables with any of the objects listed by
+        get_rebuild_losses must not be rebuilt.
+        It must run inside a transaction of connection, which makes the swap atomic.
+        '''
+        if not transfer_list:
+            return
+        if not connection.in_transaction():
+            raise DatabaseError("{} must be rebuilt inside a transaction".format(self.name))
+        preparer = connection.dialect.identifier_preparer
+        rebuilt, projection, constraints = self._get_remapped_table(self.name + '_rebuild',
+                                                                    transfer_list)
+
+        logger.info("Rebuilding %s with %d changed columns", self.name, len(transfer_list))
+        query = select(projection).compile(connection, compile_kwargs={'literal_binds': True})
+        connection.execute(text('CREATE TABLE {} AS {} WITH DATA'.format(
+            preparer.format_table(rebuilt), query)))
+        connection.execute(text('DROP TABLE {}'.format(preparer.format_table(self))))
+        connection.execute(text('ALTER TABLE {} RENAME TO {}'.format(
+            preparer.format_table(rebuilt), preparer.quote(self.name))))
+        rebuilt.name = self.name
+
+        for constraint in constraints:
+            connection.execute(AddConstraint(constraint))
+
+        for transfer in transfer_list:
+            self._rename_mapped_column(connection, transfer['name'], transfer['new_name'],
+                                       transfer['new_type'])
+
+    def remap_online(self, columns_to_add, columns_to_drop, transfer_list, workers=1):
+        '''
+        Remaps self into a shadow table while self stays available to readers. The arguments
+        are described in _get_remapped_table. The shadow table is backfilled from self,
+        in workers primary key ranges copied in parallel when the primary key is a single
+        integer column, and gets its constraints. Then, in one short transaction, self and the
+        shadow table swap names and the mapping table is updated. Rows written to self during
+        the backfill are not copied, so data must not be loaded meanwhile. Leftover shadow or
+        old tables of an interrupted remap must be dropped beforehand.
+        '''
+        engine = self.metadata.bind
+        if self.is_referenced(engine):
+            raise DatabaseError("{} is referenced by other tables and can't be remapped "
+                                "online".format(self.name))
+        shadow, projection, constraints = self._get_remapped_table(
+            self.name + '_shadow', transfer_list, columns_to_add, columns_to_drop)
+        old = Table(self.name + '_old', MetaData(), schema=self.schema)
+        preparer = engine.dialect.identifier_preparer
+        for table in [shadow, old]:
+            # Left by an interrupted remap, they may hold the only copy of the data
+            if table.exists(bind=engine):
+                raise DatabaseError("Table {} already exists, it must be dropped before "
+                                    "remapping {} online".format(table.name, self.name))
+
+        query = select(projection).compile(engine, compile_kwargs={'literal_binds': True})
+        engine.execute(text('CREATE TABLE {} AS {} WITH NO DATA'.format(
+            preparer.format_table(shadow), query)))
+        try:
+            self._backfill(shadow, projection, workers)
+            with engine.connect() as connection:
+                trans = connection.begin()
+                for constraint in constraints:
+                    connection.execute(AddConstraint(constraint))
+                trans.commit()
+
+            with engine.connect() as connection:
+                trans = connection.begin()
+                logger.info("Swapping %s with its shadow table", self.name)
+                connection.execute(text('ALTER TABLE {} RENAME TO {}'.format(
+                    preparer.format_table(self), preparer.quote(old.name))))
+                connection.execute(text('ALTER TABLE {} RENAME TO {}'.format(
+                    preparer.format_table(shadow), preparer.quote(self.name))))
+                shadow.name = self.name
+
+                mtable = self._mapping_table
+                targets = [target for _, target in columns_to_drop if target is not None]
+                if targets:
+                    connection.execute(delete(mtable).where(mtable.c.target_name.in_(targets)))
+                entries = [{'target_name': target, 'name': column_name,
+                            'type': str(get_type(field_type))}
+                           for column_name, field_type, target in columns_to_add if target]
+                if entries:
+                    connection.execute(insert(mtable), entries)
+                for transfer in transfer_list:
+                    self._rename_mapped_column(connection, transfer['name'],
+                                               transfer['new_name'], transfer['new_type'])
+                trans.commit()
+        except Exception:
+            shadow.drop(bind=engine, checkfirst=True)
+            raise
+
+        for column_name, _ in columns_to_drop:
+            column = self.columns.get(column_name)
+            if column is not None:
+                self._columns.remove(column)
+        for column_name, field_type, _ in columns_to_add:
+            if self.columns.get(column_name) is None:
+                self.append_column(Column(column_name, get_type(field_type)))
+        engine.execute(text('DROP TABLE {}'.format(preparer.format_table(old))))
+
+    def _backfill(self, shadow, projection, workers):
+        '''
+        Copies the projection of self into shadow. If workers is greater than 1 and the primary
+        key is a single integer column, the copy is split in key ranges, each one copied by
+        its own connection.
+        '''
+        engine = self.metadata.bind
+        pks = get_primary_keys(self)
+        base_query = select(projection)
+        ranges = [None]
+        if workers > 1 and len(pks) == 1 and isinstance(pks[0].type, Integer):
+            low, high = engine.execute(select([func.min(pks[0]), func.max(pks[0])])).fetchone()
+            if low is not None:
+                step = -(-(high - low + 1) // workers)
+                ranges = [(start, start + step) for start in range(low, high + 1, step)]
+
+        def copy_range(key_range):
+            '''Copies the rows of self with keys in key_range into shadow'''
+            query = base_query
+            if key_range is not None:
+                query = query.where(and_(pks[0] >= key_range[0], pks[0] < key_range[1]))
+            with engine.connect() as connection:
+                trans = connection.begin()
+                connection.execute(insert(shadow).from_select(list(shadow.columns), query))
+                trans.commit()
+
+        logger.info("Copying %s into %s in %d parts", self.name, shadow.name, len(ranges))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(copy_range, r) for r in ranges]:
+                future.result()
+
+    def is_referenced(self, bind=None):
+        '''Returns True if other tables have foreign keys referencing self'''
+        if bind is None:
+            bind = self.metadata.bind
+        insp = inspect(bind)
+        for table_name in insp.get_table_names(schema=self.schema):
+            for foreign_key in insp.get_foreign_keys(table_name, schema=self.schema):
+                if foreign_key['referred_table'] == self.name and table_name != self.name:
+                    return True
+        return False
+
+    def get_rebuild_losses(self, bind=None):
+        '''
+        Returns a list describing the objects of self that a rebuild would not recreate:
+        foreign keys of other tables referencing self, column defaults, NOT NULL columns
+        outside the primary key, unique constraints and indexes.
+        '''
+        if bind is None:
+            bind = self.metadata.bind
+        losses = []
+        if self.is_referenced(bind):
+            losses.append('foreign keys of other tables')
+
+        insp = inspect(bind)
+        primary_key = insp.get_pk_constraint(self.name, schema=self.schema)
+        for column in insp.get_columns(self.name, schema=self.schema):
+            if column['default'] is not None:
+                losses.append('default of {}'.format(column['name']))
+            if not column['nullable'] and\
+               column['name'] not in primary_key['constrained_columns']:
+                losses.append('NOT NULL of {}'.format(column['name']))
+
+        # MonetDB also lists the indexes backing keys, which are recreated with the keys
+        keys = {primary_key['name']}
+        keys.update(fk['name'] for fk in insp.get_foreign_keys(self.name, schema=self.schema))
+        for unique in insp.get_unique_constraints(self.name, schema=self.schema):
+            keys.add(unique['name'])
+            losses.append('unique constraint {}'.format(unique['name']))
+        for index in insp.get_indexes(self.name, schema=self.schema):
+            if index['name'] not in keys:
+                losses.append('index {}'.format(index['name']))
+        return losses
+
+    def choose_remap_strategy(self, update_columns, bind=None):
+        '''
+        Returns 'rebuild' if rebuilding the table is expected to be faster than transferring
+        update_columns one by one, otherwise 'columns'. Each transferred column is written
+        about three times, while a rebuild writes every column once.
+        Tables with objects a rebuild would lose (see get_rebuild_losses) are never rebuilt.
+        '''
+        if len(update_columns) < settings.REMAP_REBUILD_RATIO * len(self.columns):
+            return 'columns'
+        losses = self.get_rebuild_losses(bind)
+        if losses:
+            logger.info("%s can't be rebuilt without losing its %s", self.name,
+                        ', '.join(losses))
+            return 'columns'
+        return 'rebuild'
+
     def compare_mapping(self):
         '''
         Compares contents of mapping table to table definitions and returns tuple with differences in
@@ -632,30 +1197,34 @@ class DatabaseTable(Table):
             update_columns - columns that are in both places, but with type or name differences.
 
         The method uses target_names as the criteria to decide if columns are the same or not.
+        The mapping table is fetched in a single query.
         '''
         self.check_definitions()
         target_list = self._definitions.get_targets()
+        targets = set(target_list)
+        dbcolumns = {}
+        for column_name, parameters in self._definitions.columns.items():
+            dbcolumns.setdefault(parameters[1], (column_name, parameters[0]))
 
-        query = self._mapping_table.select()
+        mtable = self._mapping_table
+        query = select([mtable.c.target_name, mtable.c.name, mtable.c.type])
         results = self.metadata.bind.execute(query).fetchall()
-        db_target_list = [t[1] for t in results]
+        mapped = {}
+        for target_name, name, field_type in results:
+            mapped.setdefault(target_name, (name, field_type))
 
-        new_columns = [c for c in target_list if c not in db_target_list and c != '']
-        to_drop_columns = [c for c in db_target_list if c not in target_list]
+        new_columns = [c for c in target_list if c not in mapped and c != '']
+        to_drop_columns = [t[0] for t in results if t[0] not in targets]
 
         update_columns = []
         for target in target_list:
-            query = select([self._mapping_table.c.name, self._mapping_table.c.type])\
-                   .where(self._mapping_table.c.target_name == target)
-            result = self.metadata.bind.execute(query).fetchone()
-            if not result:
+            if target not in mapped:
                 continue
-            name, field_type = result
-            try:
-                new_name, new_type = self._definitions.get_dbcolumn_from_target(target)
-            except InvalidTargetError:
+            name, field_type = mapped[target]
+            if target not in dbcolumns:
                 to_drop_columns.append(target)
                 continue
+            new_name, new_type = dbcolumns[target]
             new_name = new_name.strip()
             new_type = str(get_type(new_type))
             if name == new_name and field_type == new_type:
@@ -668,18 +1237,31 @@ class DatabaseTable(Table):
 
         return new_columns, to_drop_columns, update_columns
 
-    def remap(self, auto_confirmation=True, verify_definitions=False):
+    def remap(self, auto_confirmation=True, verify_definitions=False, strategy='auto',
+              online=False, workers=1, batch_size=settings.REMAP_BATCH_SIZE, resume=False):
         '''
         Checks mapping protocol for differences in table structure - then
         attempts to apply differences according to what is recorded in the
         mapping table.
         If verify_definitions is set it will ask any difference between mapping_protocol and table_definition
+        Changed columns are updated one by one if strategy is 'columns', or by rebuilding the
+        table if it is 'rebuild'. By default, choose_remap_strategy decides.
+        Columns updated one by one are transferred in batches of batch_size rows (see
+        transfer_data_batched). An interrupted transfer must be finished by setting resume.
+        If online is set, the changes are applied to a shadow table instead, which is swapped
+        with the table at the end (see remap_online).
         '''
         self.check_definitions()
         if not self.exists():
             print("Table {} doesn't exist".format(self.name))
             return
 
+        if self.get_transfer_checkpoint() is not None:
+            if not resume:
+                raise DatabaseError("Table {} has an unfinished transfer, run remap with "
+                                    "resume to finish it".format(self.name))
+            self.resume_transfer(batch_size)
+
         mtable = self._mapping_table
 
         # Update table definitions
@@ -714,7 +1296,7 @@ class DatabaseTable(Table):
                 accept_update_columns = prompt == 'yes' or prompt == 'y' or prompt == 1
 
         with self.metadata.bind.connect() as connection:
-            # Create new columns
+            columns_to_add = []
             if accept_new_columns:
                 for target in new_columns:
                     try:
@@ -722,21 +1304,49 @@ class DatabaseTable(Table):
                     except InvalidTargetError:
                         continue
 
-                    self.add_column(dbcolumn[0], dbcolumn[1], target, bind=connection)
+                    columns_to_add.append((dbcolumn[0], dbcolumn[1], target))
 
-            # Drop columns
-            if accept_drop_columns:
-                for column in to_drop_columns:
-                    column_name = select([mtable.c.name]).where(mtable.c.target_name == column)
-                    column_name = connection.execute(column_name).fetchone()[0]
-                    if not column_name:
-                        continue
+            columns_to_drop = []
+            if accept_drop_columns and to_drop_columns:
+                query = select([mtable.c.target_name, mtable.c.name])\
+                        .where(mtable.c.target_name.in_(to_drop_columns))
+                column_names = dict(connection.execute(query).fetchall())
+                columns_to_drop = [(column_names[target], target)
+                                   for target in dict.fromkeys(to_drop_columns)
+                                   if column_names.get(target)]
+
+            if not accept_update_columns:
+                update_columns = []
+
+            if online:
+                self.remap_online(columns_to_add, columns_to_drop, update_columns, workers)
+                return
 
-                    self.drop_column(column_name, column, bind=connection)
+            if update_columns and strategy == 'auto':
+                strategy = self.choose_remap_strategy(update_columns, connection)
+            elif update_columns and strategy == 'rebuild':
+                losses = self.get_rebuild_losses(connection)
+                if losses:
+                    raise DatabaseError("{} can't be rebuilt without losing its {}".format(
+                        self.name, ', '.join(losses)))
+
+            # Structural changes are batched in a single transaction
+            trans = connection.begin()
+
+            self.add_columns(columns_to_add, bind=connection)
+            self.drop_columns(columns_to_drop, bind=connection)
 
             # Update existing columns
-            if accept_update_columns:
-                self.transfer_data(connection, update_columns)
+            if update_columns:
+                if strategy == 'rebuild':
+                    self.rebuild(connection, update_columns)
+                elif not batch_size:
+                    self.transfer_data(connection, update_columns)
+
+            trans.commit()
+
+        if update_columns and strategy != 'rebuild' and batch_size:
+            self.transfer_data_batched(update_columns, batch_size)
 
     def _get_variable_target(self, original, year):
         '''
@@ -753,12 +1363,12 @@ class DatabaseTable(Table):
                  self._protocol.target_from_original(original, year)
         # Verifies if original is actually a column target
         if target is None:
-            if original in self._protocol.get_targets():
+            if self._protocol.has_target(original):
                 target = original
 
         return target
 
-    def _derivative_recursion(self, original, year, recursion_list=[]):
+    def _derivative_recursion(self, original, year, recursion_list=None):
         '''
         Verifies if a string is a derivative, and splits it to verify if its parts are other
         derivatives themselves.
@@ -770,6 +1380,8 @@ class DatabaseTable(Table):
         '''
         if self._protocol is None:
             return {'original': original, 'dbcolumn': original, 'new': original, 'level': 0}
+        if recursion_list is None:
+            recursion_list = []
         target = self._get_variable_target(original, year)
 
 
@@ -790,7 +1402,8 @@ class DatabaseTable(Table):
 
         if is_aggregation(original):
             # Aggregation not integrated
-            derivative = {'original': original, 'dbcolumn': dbcolumn, 'new': original, 'level': -1}
+            derivative = {'original': original, 'dbcolumn': dbcolumn, 'new': original, 'level': -1,
+                          'target': target}
             self._derivatives[target] = derivative
             return derivative
 
@@ -804,7 +1417,8 @@ class DatabaseTable(Table):
             derivative = table._resolv_derivative(column, year)
 
             self._derivatives[target] = {'original': original, 'dbcolumn': dbcolumn, 'level': 0, 'dbmapped': True,
-                                         'new': '.'.join([table.name, derivative['dbcolumn'][0]])}
+                                         'new': '.'.join([table.name, derivative['dbcolumn'][0]]),
+                                         'target': target}
             return self._derivatives[target]
 
         if not original.startswith('~'):
@@ -816,12 +1430,14 @@ class DatabaseTable(Table):
         str_list = re.findall(r'("[\w]+"|[\w]+)', original)
         level = 0
         substitutions = []
+        dependencies = {}
         recursion_list.append(target)
         for substring in str_list:
             derivative = self._derivative_recursion(substring.strip('"'), year,
                                                    recursion_list=recursion_list)
             if derivative['dbcolumn']:
                 substitutions.append({'original': substring, 'new': derivative['dbcolumn'][0]})
+                dependencies[substring] = derivative
             if derivative['level'] >= level:
                 level = derivative['level'] + 1
 
@@ -831,7 +1447,8 @@ class DatabaseTable(Table):
             processed = re.sub(substitution['original'], substitution['new'], processed)
             dbmapped = True
         self._derivatives[target] = {'original': original, 'dbcolumn': dbcolumn, 'level': level,
-                                     'processed': processed, 'dbmapped': dbmapped}
+                                     'processed': processed, 'dbmapped': dbmapped,
+                                     'dependencies': dependencies, 'target': target}
         return self._derivatives[target]
 
     def _resolv_derivative(self, original, year):
@@ -843,60 +1460,99 @@ class DatabaseTable(Table):
             self._derivatives = {}
         return self._derivative_recursion(original, year)
 
-    def _get_denormalizations(self, ttable, originals, year):
+    def _denormalize(self, ttable, originals, year, bind):
         '''
-        Searches protocol for denormalizations and yields the necessary update queries.
+        Applies the denormalizations in originals, pairs of dbcolumn and original, to ttable in
+        a single pass: ttable is joined to a projection of each referenced table, restricted
+        to the referenced columns and keys, into a staging table. Rows of other years, or
+        without a referenced row, keep their values.
+        Returns the staging table, which replaces ttable: ttable is dropped and removed from
+        its metadata. ttable is returned if there is nothing to denormalize.
         '''
-        exp = r'([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)'
         external = {}
         for dst, original in originals:
             original = original.strip(' ~\n\t')
-            for match in re.finditer(exp, original):
+            for match in DENORMALIZATION_RE.finditer(original):
                 table, column = match.groups()
                 if table not in external:
-                    external[table] = []
-                external[table].append([dst, text(original)])
+                    external[table] = {'columns': set(), 'values': []}
+                external[table]['columns'].add(column)
+                external[table]['values'].append([dst[0], original])
+        if not external:
+            return ttable
 
-        for table in external:
-            query = update(ttable)
-            for dst, src in external[table]:
-                query = query.values(**{dst[0]: src})
-            for fk_column, fkey in self.get_relations(table):
-                fk_column = ttable.columns.get(fk_column.name)
-                query = query.where(fk_column == fkey)
-            if year:
-                query = query.where(ttable.columns.get(settings.YEAR_COLUMN) == year)
-            yield query
+        t_schema = ttable.schema
+        ttable.schema = None
+        source = ttable
+        values = {}
+        year_column = ttable.columns.get(settings.YEAR_COLUMN)
+        for table, references in external.items():
+            relations = list(self.get_relations(table))
+            referred = relations[0][1].table
+            keys = [fkey.name for _, fkey in relations]
+            columns = [referred.columns.get(c) for c in sorted(references['columns'] | set(keys))]
+            projection = select(columns)
+            if year and settings.YEAR_COLUMN in keys:
+                projection = projection.where(referred.columns.get(settings.YEAR_COLUMN) == year)
+            # Named after the table, so the originals can reference its columns
+            projection = projection.alias(table)
+
+            conditions = [ttable.columns.get(fk_column.name) == projection.columns.get(fkey.name)
+                          for fk_column, fkey in relations]
+            if year and year_column is not None:
+                conditions.append(year_column == year)
+            source = source.outerjoin(projection, and_(*conditions))
+
+            matched = projection.columns.get(keys[0]).isnot(None)
+            for dst, original in references['values']:
+                values[dst] = case([(matched, literal_column(original))],
+                                   else_=ttable.columns.get(dst))
+
+        columns = [values[c.name].label(c.name) if c.name in values else c
+                   for c in ttable.columns]
+        staging = Table(ttable.name + '_denormalized', ttable.metadata,
+                        *[Column(c.name, c.type, primary_key=c.primary_key)
+                          for c in ttable.columns],
+                        prefixes=['TEMPORARY'], schema=t_schema)
+        staging.create(bind=bind)
+        staging.schema = None
+        bind.execute(staging.insert().from_select(list(staging.columns),
+                                                  select(columns).select_from(source)))
+        # The staging table replaces ttable, instead of being copied back into it
+        ttable.drop(bind=bind)
+        ttable.schema = staging.schema = t_schema
+        ttable.metadata.remove(ttable)
+
+        return staging
 
     def apply_derivatives(self, ttable, columns, year, bind=None, dbonly=False):
         '''
         Given a list of columns, searches for derivatives and denormalizations and applies them
         in the appropriate order. Dependencies will be updated regardless of being or not in the
         columns list.
+        Returns the temporary table holding the results, which replaces ttable when there are
+        denormalizations (see _denormalize).
         '''
         if bind is None:
             bind = self.metadata.bind
 
-        self._derivatives = {}
-        for original in columns:
-            self._resolv_derivative(original, year)
+        # A local selection, as loads running in other threads may share self
+        derivatives = {}
+        if self._protocol is not None:
+            derivatives = self.get_derivative_graph(year).select(set(columns))
 
-        originals = [(self._derivatives[d]['dbcolumn'], self._derivatives[d]['original'])\
-                      for d in self._derivatives if self._derivatives[d]['level'] == 0]
+        originals = [(derivatives[d]['dbcolumn'], derivatives[d]['original'])\
+                      for d in derivatives if derivatives[d]['level'] == 0]
 
-        t_schema = ttable.schema
-        ttable.schema = None
-        for query in self._get_denormalizations(ttable, originals, year):
-            bind.execute(query)
+        ttable = self._denormalize(ttable, originals, year, bind)
 
-        ttable.schema = t_schema
-        if len(self._derivatives) > 0:
-            max_level = max([self._derivatives[d]['level'] for d in self._derivatives])
+        if len(derivatives) > 0:
+            max_level = max([derivatives[d]['level'] for d in derivatives])
             for i in range(max_level):
                 i = i+1
                 query = {}
-                level = [self._derivatives[d] for d in self._derivatives if\
-                         self._derivatives[d]['level'] == i]
+                level = [derivatives[d] for d in derivatives if\
+                         derivatives[d]['level'] == i]
                 for derivative in level:
                     if not dbonly or derivative['dbmapped']:
                         query[derivative['dbcolumn'][0]] = text(derivative['processed'])
@@ -905,21 +1561,141 @@ class DatabaseTable(Table):
 
                 bind.execute(query)
 
-        return self._derivatives
+        self._derivatives = derivatives
+        return ttable
+
+    def get_derivative_graph(self, year):
+        '''
+        Returns the DerivativeGraph of the derivatives and denormalizations of a year. Graphs
+        are compiled once for each version of the protocol. Compiling isn't thread safe, so
+        concurrent loads must get the graphs of their years beforehand (see prepare_years).
+        '''
+        self.check_protocol()
+        # Plans may resolve duplicates in the protocol, so they are built before fingerprinting
+        plan = self._protocol.year_plan(year)
+        key = (self.name, self._protocol.fingerprint(), year)
+        if key not in GRAPH_CACHE:
+            self._derivatives = {}
+            for target in plan.derivative_targets + plan.denormalization_targets:
+                self._resolv_derivative(self._protocol.dbcolumn_from_target(target)[0], year)
+            GRAPH_CACHE[key] = DerivativeGraph(self._derivatives)
+        return GRAPH_CACHE[key]
+
+    def prepare_years(self, years):
+        '''
+        Builds the year plans and derivative graphs of years, so loads of those years can run
+        concurrently without changing the protocol or the graph cache. Plans resolve duplicated
+        originals in the protocol, which resets the plans of other years, so every plan is
+        built before the graphs.
+        '''
+        if self._protocol is None:
+            return
+        for year in years:
+            self._protocol.year_plan(year)
+        for year in years:
+            self.get_derivative_graph(year)
+
+    def _inline_derivative(self, ttable, derivative, inlined):
+        '''
+        Returns the expression of a derivative with its dependencies inlined: derivatives are
+        replaced by their own inlined expressions, denormalizations by their expressions in
+        inlined, or else by the columns of the referred tables, and other variables by the
+        columns of ttable. Results are memoized in inlined, by the derivative dbcolumn.
+        '''
+        dbcolumn = derivative['dbcolumn'][0]
+        if dbcolumn in inlined:
+            return inlined[dbcolumn]
+
+        replacements = {}
+        for substring, dependency in derivative['dependencies'].items():
+            if dependency['level'] > 0:
+                replacement = self._inline_derivative(ttable, dependency, inlined)
+            elif dependency['level'] == 0 and 'new' in dependency:
+                replacement = inlined.get(dependency['dbcolumn'][0],
+                                          dependency['original'].strip(' ~\n\t'))
+            else:
+                replacement = '.'.join([ttable.name, dependency['dbcolumn'][0]])
+            replacements[substring] = '(' + replacement + ')'
+
+        expression = re.sub(r'("[\w]+"|[\w]+)', lambda m: replacements.get(m.group(), m.group()),
+                            derivative['original'])
+        inlined[dbcolumn] = expression
+        return expression
+
+    def get_fused_select(self, ttable, year):
+        '''
+        Returns the columns of self and a select from ttable that computes them, with the
+        derivatives and denormalizations of a year inlined in its projection. Denormalized
+        tables are left joined to ttable, and rows without a referred row keep the values of
+        ttable. Selecting from it gives the same rows as applying apply_derivatives and then
+        selecting the columns from ttable.
+        '''
+        derivatives = {}
+        expressions = {}
+        if self._protocol is not None:
+            derivatives = self.get_derivative_graph(year).select(set(ttable.columns.keys()))
+
+        external = {}
+        for derivative in derivatives.values():
+            if derivative['dbcolumn'] and derivative['level'] == 0 and 'new' in derivative:
+                original = derivative['original'].strip(' ~\n\t')
+                expressions[derivative['dbcolumn'][0]] = original
+                for match in DENORMALIZATION_RE.finditer(original):
+                    external[match.group(1)] = None
+
+        source = ttable
+        year_column = ttable.columns.get(settings.YEAR_COLUMN)
+        for table in list(external):
+            conditions = []
+            for fk_column, fkey in self.get_relations(table):
+                conditions.append(ttable.columns.get(fk_column.name) == fkey)
+                referred = fkey.table
+            if year and year_column is not None:
+                conditions.append(year_column == year)
+            source = source.outerjoin(referred, and_(*conditions))
+            # Like in _denormalize, a referred key tells if the row was matched
+            external[table] = '{}.{} IS NOT NULL'.format(referred.name, fkey.name)
+
+        for dbcolumn, original in expressions.items():
+            tables = [m.group(1) for m in DENORMALIZATION_RE.finditer(original)]
+            if tables:
+                column = ttable.columns.get(dbcolumn)
+                fallback = 'NULL' if column is None else '.'.join([ttable.name, dbcolumn])
+                matched = ' AND '.join(external[t] for t in dict.fromkeys(tables))
+                expressions[dbcolumn] = 'CASE WHEN {} THEN {} ELSE {} END'.format(
+                    matched, original, fallback)
+
+        inlined = dict(expressions)
+        for derivative in derivatives.values():
+            if derivative['dbcolumn'] and derivative['level'] > 0:
+                dbcolumn = derivative['dbcolumn'][0]
+                expressions[dbcolumn] = self._inline_derivative(ttable, derivative, inlined)
+
+        query_dst = []
+        query_src = []
+        for name, column in self.columns.items():
+            if name in expressions:
+                query_src.append(literal_column(expressions[name]).label(name))
+                query_dst.append(column)
+            elif ttable.columns.get(name) is not None:
+                query_src.append(ttable.columns.get(name))
+                query_dst.append(column)
+
+        return query_dst, select(query_src).select_from(source)
 
     def _get_aggregations(self, year):
         '''
-        Will iterate over all targets and return column and query for all aggregations.
+        Will iterate over the aggregation targets of the year plan and return column and query
+        for all aggregations.
         '''
         self.check_protocol()
 
-        for target in self._protocol.get_targets():
+        for target in self._protocol.year_plan(year).aggregation_targets:
             original = self._protocol.original_from_target(target, year)
-            if is_aggregation(original):
-                column, _ = self._protocol.dbcolumn_from_target(target)
-                if isinstance(column, str):
-                    column = self.columns.get(column)
-                    yield column, original.strip('~ ')
+            column, _ = self._protocol.dbcolumn_from_target(target)
+            if isinstance(column, str):
+                column = self.columns.get(column)
+                yield column, original.strip('~ ')
 
     def _aggregate(self, column, aggregation, source_column, year=None):
         '''
@@ -940,6 +1716,9 @@ class DatabaseTable(Table):
             selecter = selecter.where(self.columns.get(settings.YEAR_COLUMN) == year)
 
         query = update(self).values(**{column.name: selecter})
+        if year:
+            # Other years would be overwritten with empty aggregations
+            query = query.where(self.columns.get(settings.YEAR_COLUMN) == year)
 
         return query
 
@@ -966,8 +1745,8 @@ class DatabaseTable(Table):
 
         # Run derivatives
         ttable = self.create_temporary_mirror(year, bind)
-        self.apply_derivatives(ttable, ttable.columns.keys(), year, bind, dbonly=True)
-        self.update_from_temporary(ttable, ttable.columns.keys(), bind)
+        ttable = self.apply_derivatives(ttable, ttable.columns.keys(), year, bind, dbonly=True)
+        self.update_from_temporary(ttable, ttable.columns.keys(), bind, year)
 
     def get_relations(self, table):
         '''
@@ -991,34 +1770,127 @@ class DatabaseTable(Table):
 
             yield fk_column, fkey
 
-    def insert_from_temporary(self, ttable, bind=None):
+    def insert_from_temporary(self, ttable, bind=None, year=None, on_conflict=None):
         '''
-        Transfer data entries from a temporary table to self.
+        Transfer data entries from a temporary table to self. Returns the number of inserted
+        rows.
+        If a year is given, derivatives and denormalizations of the year are computed by the
+        insert itself (see get_fused_select), so apply_derivatives must not be run on ttable.
+        on_conflict sets what is done with rows whose primary key is already in self: 'skip'
+        keeps the rows of self, 'update' updates the columns that changed and 'replace'
+        deletes the rows of self before inserting. Otherwise, the insert fails on them.
         '''
+        if on_conflict is not None and on_conflict not in ON_CONFLICT_MODES:
+            raise DatabaseError('on_conflict must be one of {}'.format(
+                ', '.join(ON_CONFLICT_MODES)))
         if bind is None:
             bind = self.metadata.bind
 
+        fused = year is not None
+        if on_conflict == 'update' and fused:
+            # The keyed update needs the derivatives in ttable
+            ttable = self.apply_derivatives(ttable, ttable.columns.keys(), year, bind=bind)
+            fused = False
+
         temp_schema = ttable.schema
         ttable.schema = None
 
-        query_dst = []
-        query_src = []
-        for column in self.columns.items():
-            temporary_column = ttable.columns.get(column[0])
-            if temporary_column is not None:
-                query_src.append(temporary_column)
-                query_dst.append(column[1])
+        # Rows of ttable whose primary key is in self
+        existing = exists().where(self._match_keys(ttable, year))
+        if on_conflict == 'update':
+            self._update_changed(ttable, self.columns.keys(), bind, year)
+        elif on_conflict == 'replace':
+            rows = bind.execute(delete(self).where(existing)).rowcount
+            logger.info("Replacing %d rows of %s", rows, self.name)
 
-        query_src = select(query_src)
+        if fused:
+            query_dst, query_src = self.get_fused_select(ttable, year)
+        else:
+            query_dst = []
+            query_src = []
+            for column in self.columns.items():
+                temporary_column = ttable.columns.get(column[0])
+                if temporary_column is not None:
+                    query_src.append(temporary_column)
+                    query_dst.append(column[1])
+
+            query_src = select(query_src)
+        if on_conflict in ['skip', 'update']:
+            query_src = query_src.where(~existing.correlate_except(self))
         query = insert(self).from_select(query_dst, query_src)
 
-        bind.execute(query)
+        result = bind.execute(query)
 
         ttable.schema = temp_schema
 
-    def update_from_temporary(self, ttable, columns, bind=None):
+        return result.rowcount
+
+    def delete_year(self, year, bind=None):
+        '''Deletes the rows of a year from self. Returns the number of deleted rows.'''
+        if bind is None:
+            bind = self.metadata.bind
+        year_column = self.columns.get(settings.YEAR_COLUMN)
+        if year_column is None:
+            raise DatabaseColumnError(settings.YEAR_COLUMN)
+
+        rows = bind.execute(delete(self).where(year_column == year)).rowcount
+        logger.info("Deleted %d rows of %s from %s", rows, year, self.name)
+        return rows
+
+    def _match_keys(self, ttable, year=None):
+        '''
+        Returns the condition matching rows of self and ttable by primary key. If a year is
+        given and self has a year column, it is part of the condition, so only the rows of
+        that year are visited. The year is compared to a constant, since the year column of
+        ttable may not have been loaded from the file.
+        '''
+        conditions = [column == ttable.columns.get(column.name)
+                      for column in get_primary_keys(self)]
+        year_column = self.columns.get(settings.YEAR_COLUMN)
+        if year is not None and year_column is not None:
+            conditions.append(year_column == year)
+        return and_(*conditions)
+
+    def _update_changed(self, ttable, columns, bind, year=None):
+        '''
+        Updates columns of the rows of self that have a row with the same primary key in
+        ttable, restricted to the rows where any of the columns differs. Values are taken by
+        correlated subqueries, since UPDATE ... FROM can't be compiled for every backend.
+        If a year is given, only rows of that year are matched. Returns the number of
+        changed rows and cells.
+        '''
+        keys = self._match_keys(ttable, year)
+        values = {}
+        differs = []
+        for name in columns:
+            column = self.columns.get(name)
+            temporary_column = ttable.columns.get(name)
+            if column is not None and temporary_column is not None and not column.primary_key:
+                values[name] = select([temporary_column]).where(keys).as_scalar()
+                differs.append(column.is_distinct_from(temporary_column))
+        if not differs:
+            return 0, 0
+
+        counts = [func.count()] + [func.sum(case([(d, 1)], else_=0)) for d in differs]
+        counts = select(counts).select_from(self.join(ttable, keys)).where(or_(*differs))
+        rows, *cells = bind.execute(counts).fetchone()
+        cells = sum(c or 0 for c in cells)
+        if rows:
+            query = update(self).values(**values)
+            year_column = self.columns.get(settings.YEAR_COLUMN)
+            if year is not None and year_column is not None:
+                query = query.where(year_column == year)
+            query = query.where(exists().where(and_(keys, or_(*differs))))
+            bind.execute(query)
+        logger.info("Updated %d cells in %d changed rows of %s", cells, rows, self.name)
+
+        return rows, cells
+
+    def update_from_temporary(self, ttable, columns, bind=None, year=None):
         '''
-        Update data in columns from self from a given temporary table.
+        Update data in columns from self from a given temporary table. Only rows where any of
+        the columns differs are rewritten. If a year is given, only rows of that year are
+        matched. Returns the number of changed rows and cells.
         '''
         if bind is None:
             bind = self.metadata.bind
@@ -1026,21 +1898,12 @@ class DatabaseTable(Table):
         temp_schema = ttable.schema
         ttable.schema = None
 
-        query = {}
-        for column in columns:
-            temporary_column = ttable.columns.get(column)
-            if temporary_column is not None:
-                query[column] = temporary_column
-
-        query = update(self).values(**query)
-        pk = ttable.primary_key.columns.items()
-        for column_name, temp_column in pk:
-            column = self.columns.get(column_name)
-            query = query.where(column == temp_column)
-        bind.execute(query)
+        result = self._update_changed(ttable, columns, bind, year)
 
         ttable.schema = temp_schema
 
+        return result
+
     def check_definitions(self):
         ''' Raises MissingDefinitionsError if the definitions is not loaded.'''
         if self._definitions is None:
@@ -0,0 +1,80 @@
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Compiled graphs of the derivatives of a table'''
+
+# Compiled graphs, by table name, protocol fingerprint and year
+GRAPH_CACHE = {}
+
+
+class DerivativeGraph(object):
+    '''
+    Derivatives, denormalizations and aggregations used by a table in a given year.
+    derivatives maps each target to its resolution, as built by
+    DatabaseTable._derivative_recursion; edges maps each target to the targets it depends
+    on; levels lists the targets of each level, in increasing order. Level 0 targets are
+    denormalizations, level -1 are aggregations, and each level above 0 costs an UPDATE
+    pass over the temporary table.
+    '''
+    def __init__(self, derivatives):
+        self.derivatives = derivatives
+        self.edges = {}
+        levels = {}
+        for target, derivative in derivatives.items():
+            dependencies = derivative.get('dependencies', {}).values()
+            self.edges[target] = [d['target'] for d in dependencies if 'target' in d]
+            levels.setdefault(derivative['level'], []).append(target)
+        self.levels = sorted(levels.items())
+
+    def select(self, dbcolumns):
+        '''
+        Returns the derivatives that compute any of dbcolumns, along with the derivatives
+        they depend on.
+        '''
+        pending = [t for t, d in self.derivatives.items()
+                   if d['dbcolumn'] and d['dbcolumn'][0] in dbcolumns]
+        selected = set()
+        while pending:
+            target = pending.pop()
+            if target not in selected:
+                selected.add(target)
+                pending += self.edges[target]
+        return {t: d for t, d in self.derivatives.items() if t in selected}
+
+    def explain(self):
+        '''Returns a description of the levels of the graph, with their SQL expressions'''
+        lines = []
+        for level, targets in self.levels:
+            if level < 0:
+                lines.append('Aggregations (run by run_aggregations):')
+            elif level == 0:
+                lines.append('Level 0, denormalizations:')
+            else:
+                lines.append('Level {}:'.format(level))
+            for target in targets:
+                derivative = self.derivatives[target]
+                dbcolumn = derivative['dbcolumn'][0] if derivative['dbcolumn'] else None
+                expression = derivative.get('processed', derivative['original'])
+                lines.append('    {} ({}) = {}'.format(target, dbcolumn, expression.strip()))
+                if self.edges[target]:
+                    lines.append('        depends on {}'.format(', '.join(self.edges[target])))
+        passes = max([level for level, _ in self.levels] + [0])
+        lines.append('{} UPDATE pass(es) over the temporary table'.format(passes))
+        return '\n'.join(lines)
@@ -23,10 +23,14 @@ Names comonly used:
 - original columns: columns as they are named in the original database;
 - target columns: columns as named internaly in project;
 - dbcolumns: columns as named in database.'''
+import os
+import re
+import pickle
+import hashlib
 import logging
-import pandas as pd
 
 from database.base import InvalidTargetError, DuplicateColumnNameError
+import settings
 
 
 logger = logging.getLogger(__name__)
@@ -40,172 +44,420 @@ standard_columns = {
     'temporary_column': 'Coluna temporária'
 }
 
+# Bump whenever the contents of the compiled protocol cache change
+CACHE_VERSION = 1
+
+AGGREGATION_RE = re.compile(r'^~[a-zA-Z0-9_]+\(.+\)')
+DENORMALIZATION_RE = re.compile(r'~?([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)')
+
+def get_cache_path(in_file):
+    '''Returns the path of the compiled cache kept next to a protocol csv'''
+    directory, file_name = os.path.split(in_file)
+    return os.path.join(directory, '.' + file_name + '.cache')
+
+def get_file_digest(in_file):
+    '''Returns the sha1 hex digest of a file contents'''
+    with open(in_file, 'rb') as protocol_file:
+        return hashlib.sha1(protocol_file.read()).hexdigest()
+
+def _to_native(value):
+    '''Converts numpy scalars to python objects, so the cache can be read without numpy'''
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+class YearPlan(object):
+    '''Mapping of a protocol for a single year. It is computed once per (protocol, year) and
+    shared by every stage of an insertion, so headers don't need to be resolved again.
+    - dbcolumns: dictionary original -> dbcolumn of every mapped original;
+    - table_columns: list of [dbcolumn, type] for every valid target;
+    - derivative_targets: targets calculated from other columns (original starts with ~);
+    - denormalization_targets: targets taken from another table (table.column);
+    - aggregation_targets: targets aggregated from another table (~func(table.column));
+    - referenced: names that appear in the expressions of derivatives.
+    Headers that can't be resolved only raise InvalidTargetError when a header with them is
+    planned, as lookups do.'''
+    def __init__(self, protocol, year):
+        self.year = year
+        self.dbcolumns = {}
+        self.table_columns = []
+        self.derivative_targets = []
+        self.denormalization_targets = []
+        self.aggregation_targets = []
+        self.referenced = set()
+        self._unresolved = {}
+
+        # Duplicated headers become derivatives, so they must be resolved before anything.
+        # Repeated derivative expressions are not headers and are left as they are
+        for original, indexes in list(protocol._original_index[year].items()):
+            if len(indexes) < 2 or not isinstance(original, str) or\
+               not original.strip() or original.strip().startswith('~'):
+                continue
+            try:
+                protocol.resolve_duplicates(year, indexes)
+            except InvalidTargetError as error:
+                self._unresolved[original] = error
+
+        for target in protocol.get_targets():
+            try:
+                dbcolumn = protocol.dbcolumn_from_target(target)
+            except InvalidTargetError:
+                continue
+            self.table_columns.append(dbcolumn)
+
+            original = protocol.original_from_target(target, year)
+            if not isinstance(original, str) or not original.strip() or\
+               original in self._unresolved:
+                continue
+            self.dbcolumns[original] = dbcolumn[0]
+
+            original = original.strip()
+            if AGGREGATION_RE.search(original):
+                self.aggregation_targets.append(target)
+            elif DENORMALIZATION_RE.match(original):
+                self.denormalization_targets.append(target)
+            elif original.startswith('~'):
+                self.derivative_targets.append(target)
+                names = re.findall(r'("[\w]+"|[\w]+)', original)
+                self.referenced.update(name.strip('"') for name in names)
+
+    def _check_header(self, header):
+        '''Raises the error of the first column of header that couldn't be resolved'''
+        for column in header:
+            if column in self._unresolved:
+                raise self._unresolved[column]
+
+    def get_unmapped(self, header):
+        '''Returns the columns of a header that are not mapped to any dbcolumn'''
+        self._check_header(header)
+        return [column for column in header if column not in self.dbcolumns]
+
+    def get_used(self, header):
+        '''
+        Returns the columns of a header that are needed to fill the table: mapped columns
+        and columns referenced by derivatives.
+        '''
+        self._check_header(header)
+        return [column for column in header
+                if column in self.dbcolumns or column in self.referenced]
+
+    def get_dbcolumns(self, header):
+        '''Translates a header to dbcolumns, unmapped columns keep their original name'''
+        self._check_header(header)
+        return [self.dbcolumns.get(column, column) for column in header]
+
 class Protocol(object):
     ''' Protocol for table translation'''
     def __init__(self, in_file=None, columns=None):
-        self._dataframe = None
-        self._remaped = None
+        self._frame = None
+        self._fields = []
+        self._records = None
+        self._targets = []
+        self._target_index = {}
+        self._dbcolumn_index = {}
+        self._original_index = {}
+        self._year_plans = {}
+        self._fingerprint = None
         self.columns = standard_columns.copy()
         if in_file:
             self.load_csv(in_file, columns)
 
+    @property
+    def _dataframe(self):
+        '''Dataframe with the protocol contents. Lookups only use the records, so it is
+        assembled on first access.'''
+        if self._frame is None and self._records is not None:
+            import pandas as pd
+            self._frame = pd.DataFrame(self._records, columns=self._fields)
+        return self._frame
+
+    @_dataframe.setter
+    def _dataframe(self, dataframe):
+        self._load_dataframe(dataframe)
+
+    @property
+    def _remaped(self):
+        '''Series with the targets of the protocol'''
+        if self._dataframe is None:
+            return None
+        return self._dataframe[self.columns['target_name']]
+
     def load_csv(self, in_file, columns=None):
-        ''' Loads csv into TableDict '''
-        self._dataframe = pd.read_csv(in_file)
-        self._dataframe = self._dataframe.fillna('')
+        ''' Loads csv into TableDict. If in_file is a path, a compiled version of the
+        protocol is cached next to it and used while the csv is unchanged. '''
         if isinstance(columns, dict):
             for column in columns:
                 self.columns[column] = columns[column]
-        else:
-            columns = standard_columns.copy()
-        self._remaped = self._dataframe[columns['target_name']]
+
+        use_cache = settings.PROTOCOL_CACHE and isinstance(in_file, str)
+        if use_cache and self._load_cache(in_file):
+            return
+
+        self._load_dataframe(self._read_csv(in_file))
+
+        if use_cache:
+            self._write_cache(in_file)
+
+    @staticmethod
+    def _read_csv(in_file):
+        '''Reads a protocol csv into a dataframe. pandas is only imported on this path and
+        when the dataframe is needed, so protocols loaded from the cache don't import it.'''
+        import pandas as pd
+        return pd.read_csv(in_file).fillna('')
+
+    def _load_dataframe(self, dataframe):
+        '''Replaces the protocol contents with the ones of a dataframe'''
+        self._fields = list(dataframe.columns)
+        self._records = [{k: _to_native(v) for k, v in record.items()}
+                         for record in dataframe.to_dict('records')]
+        self._frame = dataframe
+        self._build_indexes()
+
+    def _load_cache(self, in_file):
+        '''Loads the compiled protocol for in_file. Returns False if there is no valid cache.'''
+        cache_path = get_cache_path(in_file)
+        try:
+            stat = os.stat(in_file)
+            with open(cache_path, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return False
+
+        if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION or\
+           cache.get('columns') != self.columns:
+            return False
+
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if cache['stat'] != stat:
+            # File was touched, it is only stale if the contents changed
+            if cache['digest'] != get_file_digest(in_file):
+                logger.debug("Protocol cache %s is stale", cache_path)
+                return False
+            cache['stat'] = stat
+            self._dump_cache(cache_path, cache)
+
+        logger.debug("Using protocol cache %s", cache_path)
+        self._frame = None
+        self._year_plans = {}
+        self._fingerprint = None
+        self._fields = cache['fields']
+        self._records = cache['records']
+        self._targets = cache['targets']
+        self._target_index = cache['target_index']
+        self._dbcolumn_index = cache['dbcolumn_index']
+        self._original_index = cache['original_index']
+        return True
+
+    def _write_cache(self, in_file):
+        '''Stores the compiled protocol next to in_file'''
+        stat = os.stat(in_file)
+        cache = {
+            'version': CACHE_VERSION,
+            'stat': (stat.st_mtime_ns, stat.st_size),
+            'digest': get_file_digest(in_file),
+            'columns': self.columns,
+            'fields': self._fields,
+            'records': self._records,
+            'targets': self._targets,
+            'target_index': self._target_index,
+            'dbcolumn_index': self._dbcolumn_index,
+            'original_index': self._original_index
+        }
+        self._dump_cache(get_cache_path(in_file), cache)
+
+    @staticmethod
+    def _dump_cache(cache_path, cache):
+        '''Atomically writes a cache file. Failing to write it is not an error.'''
+        temp_path = '{}.{}'.format(cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as cache_file:
+                pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            logger.warning("Could not write protocol cache %s", cache_path)
+
+    def _build_indexes(self):
+        '''Builds the dictionaries used to resolve lookups without scanning the dataframe.
+        Every index maps a value to the list of row positions holding it, so duplicates
+        can still be detected.'''
+        self._targets = [r[self.columns['target_name']] for r in self._records]
+        self._year_plans = {}
+        self._fingerprint = None
+        self._target_index = {}
+        self._dbcolumn_index = {}
+        self._original_index = {}
+
+        years = [c for c in self._fields if c not in self.columns.values()]
+        for year in years:
+            self._original_index[year] = {}
+
+        for i, (record, target) in enumerate(zip(self._records, self._targets)):
+            self._target_index.setdefault(target, []).append(i)
+            self._dbcolumn_index.setdefault(record.get(standard_columns['database_name']),
+                                            []).append(i)
+            for year in years:
+                self._original_index[year].setdefault(record[year], []).append(i)
+
+    def _set_value(self, position, column, value):
+        '''Changes a single protocol cell, keeping the lookup indexes up to date'''
+        old_value = self._records[position][column]
+        self._year_plans = {}
+        self._fingerprint = None
+        self._records[position][column] = value
+        if self._frame is not None:
+            self._frame.iloc[position, self._frame.columns.get_loc(column)] = value
+
+        if column in self._original_index:
+            index = self._original_index[column]
+            index[old_value].remove(position)
+            if not index[old_value]:
+                del index[old_value]
+            index.setdefault(value, []).append(position)
+
+    def fingerprint(self):
+        '''Returns a digest of the protocol contents, which changes whenever they do'''
+        if self._fingerprint is None:
+            contents = pickle.dumps((self._fields, self._records))
+            self._fingerprint = hashlib.sha1(contents).hexdigest()
+        return self._fingerprint
 
     def get_targets(self):
         '''Returns the list of targets from the protocol file'''
-        return list(self._remaped)
+        return list(self._targets)
+
+    def has_target(self, name):
+        '''Returns True if name is a target of the protocol'''
+        return name in self._target_index
+
+    def year_plan(self, year):
+        '''Returns the YearPlan of a given year. Plans are memoized until the protocol changes.'''
+        if year not in self._year_plans:
+            self._year_plans[year] = YearPlan(self, year)
+        return self._year_plans[year]
 
     def target_from_original(self, name, year):
         '''Gets a target column from an original name and a year
         Input example: **{'name': 'TP_COR_RACA', 'year': '2015'}
         output could look like 'CEBMA015N0' '''
-        if self._dataframe is None:
+        if self._records is None:
             return None
-        indexes = self._dataframe[self._dataframe[year] == name].index.tolist()
+        indexes = self._original_index[year].get(name)
         if not indexes:
             return None
         if len(indexes) > 1:
             self.resolve_duplicates(year, indexes)
 
-        return self._remaped[indexes[0]]
+        return self._targets[indexes[0]]
 
     def resolve_duplicates(self, year, indexes):
         '''
         Transforms a dbcolumn that gets the data from the same header to a denormalization of the first column.
         '''
-        original_dbcolumn = self.dbcolumn_from_target(self._remaped[indexes[0]])[0]
+        indexes = list(indexes)
+        original_dbcolumn = self.dbcolumn_from_target(self._targets[indexes[0]])[0]
 
         for i in range(1, len(indexes)):
-            self._dataframe.loc[indexes[i], year] = '~' + original_dbcolumn
+            self._set_value(indexes[i], year, '~' + original_dbcolumn)
 
     def original_from_target(self, name, year):
         '''Gets original column from target column and a year
         Input example: **{'name': 'CEBMA015N0', 'year': '2015'}
         output could look like 'TP_COR_RACA' '''
-        if self._dataframe is None:
+        if self._records is None:
             return None
-        indexes = self._dataframe[self._remaped == name].index.tolist()
+        indexes = self._target_index.get(name)
         if not indexes:
             return None
         if len(indexes) > 1:
             return None
-        return self._dataframe[year][indexes[0]]
+        return self._records[indexes[0]][year]
 
     def target_from_dbcolumn(self, name):
         '''Returns the target corresponding to a given dbcolumn'''
-        if self._dataframe is None:
+        if self._records is None:
             return None
-        indexes = self._dataframe[self._dataframe[standard_columns['database_name']]\
-                  == name].index.tolist()
+        indexes = self._dbcolumn_index.get(name)
         if not indexes:
             return None
         if len(indexes) > 1:
             raise DuplicateColumnNameError(name)
-        return self._remaped[indexes[0]]
+        return self._targets[indexes[0]]
 
     def get_temporary_columns(self, year):
-        dataframe = self._dataframe
-        indexes = dataframe[dataframe[standard_columns['temporary_column']] == 1].index.tolist()
-
-        df = dataframe.iloc[indexes][[
-            standard_columns['database_name'],
-            standard_columns['data_type'],
-            year]
-        ]
-
-        return [l[1].tolist() for l in df.iterrows()]
+        return [[r[standard_columns['database_name']], r[standard_columns['data_type']], r[year]]
+                for r in self._records if r.get(standard_columns['temporary_column']) == 1]
 
     def dbcolumn_from_target(self, name):
         '''Gets database column from a target column name. Ouput is a list
         with the column name and type contents.
         Input example: **{'name': 'CEBMA015N0'}
         output could look like ['cor_raca_id', 'TINYINT'] '''
-        indexes = self._dataframe[self._remaped == name].index.tolist()
-        if len(indexes) > 1:
-            indexes = None
-        if indexes:
-            try:
-                is_temp = self._dataframe[standard_columns['temporary_column']]
-                is_temp = is_temp[indexes[0]]
-            except KeyError:
-                logger.warning("Protocol doesn't have temporary identifier")
-                is_temp = None
-
-        if not indexes:
+        indexes = self._target_index.get(name)
+        if not indexes or len(indexes) > 1:
             raise InvalidTargetError(name)
-        column_name = self._dataframe[standard_columns['database_name']][indexes[0]].strip()
-        column_type = self._dataframe[standard_columns['data_type']][indexes[0]].strip()
+        record = self._records[indexes[0]]
+        column_name = record[standard_columns['database_name']].strip()
+        column_type = record[standard_columns['data_type']].strip()
         if not column_name or not column_type:
             raise InvalidTargetError(name)
         return [column_name, column_type]
 
     def get_comment(self, target):
-        indexes = self._dataframe[self._remaped == target].index.tolist()
-        if len(indexes) > 1:
-            indexes = None
-        if indexes:
-            try:
-                is_temp = self._dataframe[standard_columns['temporary_column']]
-                is_temp = is_temp[indexes[0]]
-            except KeyError:
-                logger.warning("Protocol doesn't have temporary identifier")
-                is_temp = None
-
-        if not indexes or is_temp:
+        indexes = self._target_index.get(target)
+        if not indexes or len(indexes) > 1:
+            raise InvalidTargetError(target)
+        record = self._records[indexes[0]]
+        try:
+            is_temp = record[standard_columns['temporary_column']]
+        except KeyError:
+            logger.warning("Protocol doesn't have temporary identifier")
+            is_temp = None
+
+        if is_temp:
             raise InvalidTargetError(target)
-        comment = self._dataframe[standard_columns['description']][indexes[0]]
-        return comment
+        return record[standard_columns['description']]
 
     def get_tabbed_mapping(self, year):
-        column_names = list(self._dataframe[self._dataframe['p0' + year] != ''][year])
+        column_names = [r[year] for r in self._records if r['p0' + year] != '']
 
-
-        column_mappings = [list(c) for _, c in
-                           self._dataframe[['p0' + year, 'pf' + year]].iterrows() if bool(c[0])]
+        column_mappings = [[r['p0' + year], r['pf' + year]] for r in self._records
+                           if bool(r['p0' + year])]
         return column_names, column_mappings
 
     def remap_from_protocol(self, new_protocol, column_list, reference_year='2015'):
-        '''Method to update a mapping protocol from another file'''
-        cur_targets = self.get_targets()
-
-        for target in cur_targets:
-            original = self.original_from_target(target, reference_year)
-            new_target = new_protocol.target_from_original(original, reference_year)
-
-            if new_target and target != new_target:
-                print('[' + target + ']', '[' + new_target + ']')
-                self._dataframe[self._dataframe[self.columns['target_name']] ==\
-                                target][self.columns['target_name']] = new_target
-                self._remaped[self._remaped == target] = new_target
-
-
-        new_targets = new_protocol.get_targets()
+        '''Method to update a mapping protocol from another file.
+        Both protocols are joined by the originals of reference_year: targets are renamed to
+        match new_protocol, targets missing from it are dropped, its new targets are appended
+        and the columns in column_list are copied from it.'''
+        import pandas as pd
+        target_name = self.columns['target_name']
+        dataframe = self._dataframe.copy()
+        new_dataframe = new_protocol._dataframe
+
+        # Rename targets whose reference original is mapped to another target
+        new_originals = new_dataframe[new_dataframe[reference_year] != '']
+        new_originals = new_originals.drop_duplicates(reference_year)
+        new_originals = new_originals.set_index(reference_year)[target_name]
+        renamed = dataframe[reference_year].map(new_originals)
+        changed = renamed.notna() & (renamed != dataframe[target_name])
+        for target, new_target in zip(dataframe.loc[changed, target_name], renamed[changed]):
+            logger.info("Renaming target %s to %s", target, new_target)
+        dataframe.loc[changed, target_name] = renamed[changed]
+        # A renamed target may collide with a target that kept its name, wherever it is, or
+        # with another renamed target sharing its original. Only the first is kept.
+        collides = dataframe[target_name].isin(dataframe.loc[~changed, target_name])
+        dataframe = dataframe[~(changed & (collides | dataframe[target_name].duplicated()))]
 
         # Exclude unused targets
-        to_exclude = [t for t in cur_targets if t not in new_targets]
-        for target in to_exclude:
-            indexes = self._dataframe[self._remaped == target].index.tolist()
-            self._dataframe = self._dataframe.drop(indexes)
-            self._dataframe = self._dataframe.reset_index(drop=True)
-            self._remaped = self._remaped.drop(indexes)
-            self._remaped = self._remaped.reset_index(drop=True)
-
-        self._dataframe.index = self._remaped
-        new_protocol._dataframe.index = new_protocol._remaped
+        dataframe = dataframe[dataframe[target_name].isin(new_dataframe[target_name])]
 
-        new_targets = [c for c in list(new_protocol._remaped) if c not in cur_targets]
+        new_rows = new_dataframe[~new_dataframe[target_name].isin(dataframe[target_name])]
+        dataframe = pd.concat([dataframe, new_rows], ignore_index=True, sort=False)
 
-        new_rows = new_protocol._dataframe.loc[new_targets]
-        self._dataframe = pd.concat([self._dataframe, new_rows])
+        if column_list:
+            new_columns = new_dataframe.drop_duplicates(target_name).set_index(target_name)
+            new_columns = new_columns[column_list].reindex(dataframe[target_name])
+            for column in column_list:
+                dataframe[column] = new_columns[column].values
 
-        for column in column_list:
-            self._dataframe[column] = new_protocol._dataframe[column]
+        self._load_dataframe(dataframe.fillna(''))
@@ -0,0 +1,219 @@
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+''' Routines to stream input files into the database: compressed files are decompressed on
+the fly, and streams are exposed to the server through named pipes.'''
+import bz2
+import gzip
+import logging
+import lzma
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from itertools import islice
+
+from database.base import DatabaseError
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+COMPRESSED_EXTENSIONS = ['.gz', '.bz2', '.xz', '.zip', '.7z']
+
+def is_compressed(file_name):
+    '''Whether file_name is decompressed by open_input, according to its extension'''
+    return os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS
+
+def _largest_zip_member(archive):
+    '''Returns the largest file of a zip archive, which holds the data in microdata archives'''
+    members = [m for m in archive.infolist() if not m.is_dir()]
+    if not members:
+        raise DatabaseError('Empty archive {}'.format(archive.filename))
+    return max(members, key=lambda m: m.file_size).filename
+
+def _largest_7z_member(file_name):
+    '''Returns the largest file of a 7z archive, listed by the 7z command'''
+    listing = subprocess.run(['7z', 'l', '-slt', file_name], stdout=subprocess.PIPE,
+                             check=True).stdout.decode(errors='replace')
+    members = []
+    for block in listing.split('\n\n'):
+        fields = dict(line.split(' = ', 1) for line in block.splitlines() if ' = ' in line)
+        if 'Size' in fields and fields.get('Folder') == '-':
+            members.append((int(fields['Size'] or 0), fields['Path']))
+    if not members:
+        raise DatabaseError('Empty archive {}'.format(file_name))
+    return max(members)[1]
+
+@contextmanager
+def open_input(file_name):
+    '''
+    Opens an input file for binary reading. Files compressed with gzip, bzip2 or xz are
+    decompressed on the fly; for zip and 7z archives, their largest file is read.
+    7z archives require the 7z command.
+    '''
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.gz':
+        with gzip.open(file_name, 'rb') as input_file:
+            yield input_file
+    elif extension == '.bz2':
+        with bz2.open(file_name, 'rb') as input_file:
+            yield input_file
+    elif extension == '.xz':
+        with lzma.open(file_name, 'rb') as input_file:
+            yield input_file
+    elif extension == '.zip':
+        with zipfile.ZipFile(file_name) as archive:
+            member = _largest_zip_member(archive)
+            logger.info("Reading %s from %s", member, file_name)
+            with archive.open(member) as input_file:
+                yield input_file
+    elif extension == '.7z':
+        if shutil.which('7z') is None:
+            raise DatabaseError('The 7z command is required to read {}'.format(file_name))
+        member = _largest_7z_member(file_name)
+        logger.info("Reading %s from %s", member, file_name)
+        process = subprocess.Popen(['7z', 'e', '-so', file_name, member],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+    else:
+        with open(file_name, 'rb') as input_file:
+            yield input_file
+
+def iterate_input(file_name, chunk_size=settings.UPLOAD_CHUNK_SIZE):
+    '''Yields the (decompressed) contents of an input file in chunks of chunk_size bytes'''
+    with open_input(file_name) as input_file:
+        chunk = input_file.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = input_file.read(chunk_size)
+
+def sample_lines(file_name, amount, skip=1, parts=10):
+    '''
+    Returns up to about amount lines of a file, after its first skip lines. Plain files are
+    sampled at parts evenly spaced positions, so the sample covers the whole file, while
+    compressed files are sampled from the beginning. Lines are returned as bytes.
+    '''
+    with open_input(file_name) as input_file:
+        for _ in range(skip):
+            input_file.readline()
+        if is_compressed(file_name) or parts <= 1:
+            return list(islice(input_file, amount))
+
+        start = input_file.tell()
+        size = os.path.getsize(file_name) - start
+        lines = []
+        for part in range(parts):
+            input_file.seek(start + size * part // parts - 1 if part else start)
+            if part:
+                # Moves to the start of the next line
+                input_file.readline()
+            end = start + size * (part + 1) // parts
+            for _ in range(-(-amount // parts)):
+                if input_file.tell() >= end:
+                    break
+                lines.append(input_file.readline())
+        return lines
+
+def split_ranges(file_name, range_size, start=0):
+    '''
+    Splits a file, from byte start on, into byte ranges [start, end) of about range_size
+    bytes. Every range starts at the beginning of a line.
+    '''
+    file_size = os.path.getsize(file_name)
+    ranges = []
+    with open(file_name, 'rb') as input_file:
+        while start < file_size:
+            end = start + max(range_size, 1)
+            if end < file_size:
+                # Moves the end of the range to the start of the next line
+                input_file.seek(end - 1)
+                input_file.readline()
+                end = input_file.tell()
+            end = min(end, file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def position_after_lines(file_name, amount):
+    '''Returns the position of a file after its first amount lines'''
+    with open(file_name, 'rb') as input_file:
+        for _ in range(amount):
+            input_file.readline()
+        return input_file.tell()
+
+def iterate_range(file_name, start, end, chunk_size=settings.UPLOAD_CHUNK_SIZE):
+    '''Yields the byte range [start, end) of a file in chunks of up to chunk_size bytes'''
+    with open(file_name, 'rb') as input_file:
+        input_file.seek(start)
+        while start < end:
+            chunk = input_file.read(min(chunk_size, end - start))
+            if not chunk:
+                return
+            start += len(chunk)
+            yield chunk
+
+@contextmanager
+def fifo(chunks, name):
+    '''
+    Creates a named pipe fed with an iterable of bytes chunks by a background thread, and
+    yields its path. The pipe can be read by the database server in the same way as a file,
+    so it must run on the same host.
+    '''
+    directory = tempfile.mkdtemp(prefix='hotmapper_')
+    fifo_name = os.path.join(directory, os.path.basename(name))
+    os.mkfifo(fifo_name)
+    # The database server usually runs as another user
+    os.chmod(directory, 0o755)
+    os.chmod(fifo_name, 0o644)
+
+    errors = []
+    def feed():
+        '''Writes the chunks into the pipe'''
+        try:
+            with open(fifo_name, 'wb') as fifo_file:
+                for chunk in chunks:
+                    fifo_file.write(chunk)
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    try:
+        yield fifo_name
+    finally:
+        while thread.is_alive():
+            # The pipe was not read until the end. Opening and closing it releases the writer
+            # either blocked on open or on a full pipe, which fails with a broken pipe.
+            os.close(os.open(fifo_name, os.O_RDONLY | os.O_NONBLOCK))
+            thread.join(0.1)
+        shutil.rmtree(directory)
+
+    if errors:
+        logger.error("Error writing %s into the pipe", name)
+        raise errors[0]
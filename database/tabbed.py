@@ -0,0 +1,380 @@
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+''' Routines to decode tabbed (fixed width positional) files.
+Records are read in blocks and viewed as 2-D byte arrays with one record per row, so each
+column of a whole block is decoded with a few array operations.
+Positions are byte offsets: column mappings are given as [initial position, length], with
+positions starting at 1.'''
+import logging
+import os
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+
+from database import streams
+
+
+logger = logging.getLogger(__name__)
+
+# Encoding of tabbed files. Values are stripped as str.strip() strips them once decoded
+ENCODING = 'latin-1'
+
+# Byte classes used when stripping values: whitespace is stripped first, and then dots,
+# used to fill empty fields in some files. Quoted bytes must be quoted in csv files.
+WHITESPACE = 1
+DOT = 2
+QUOTED = 4
+
+def get_byte_classes(encoding=ENCODING):
+    '''
+    Returns the classes of each byte in an encoding. Whitespace is marked as str.isspace()
+    sees it. In multi-byte encodings only ASCII bytes can be marked, and values with other
+    bytes at their edges must be stripped by strip_value.
+    '''
+    try:
+        characters = bytes(range(256)).decode(encoding)
+    except UnicodeDecodeError:
+        characters = ''
+    if len(characters) != 256:
+        characters = bytes(range(128)).decode('ascii') + '\x00' * 128
+
+    byte_classes = np.zeros(256, dtype=np.uint8)
+    byte_classes[[i for i, character in enumerate(characters) if character.isspace()]] |= WHITESPACE
+    byte_classes[ord('.')] |= DOT
+    byte_classes[list(b'"\n\r')] |= QUOTED
+    return byte_classes
+
+def is_single_byte(encoding):
+    '''Returns True if every byte is a character of encoding'''
+    try:
+        return len(bytes(range(256)).decode(encoding)) == 256
+    except UnicodeDecodeError:
+        return False
+
+def strip_value(value, encoding=ENCODING):
+    '''Returns the start and end (exclusive) of a value stripped of whitespace and dots'''
+    text = value.decode(encoding, 'surrogateescape')
+    stripped = text.strip()
+    start = len(text) - len(text.lstrip()) + len(stripped) - len(stripped.lstrip('.'))
+    stripped = stripped.strip('.')
+    if not stripped:
+        return 0, 0
+    start = len(text[:start].encode(encoding, 'surrogateescape'))
+    return start, start + len(stripped.encode(encoding, 'surrogateescape'))
+
+class TabbedLayout(object):
+    ''' Positions of the columns of a tabbed file inside its records. Every column is
+    gathered into a segment with one extra byte at its end, used as separator when the
+    block is written as csv.'''
+    def __init__(self, column_mappings, record_length, encoding=ENCODING):
+        self.record_length = record_length
+        self.encoding = encoding
+        self.byte_classes = get_byte_classes(encoding)
+        self.single_byte = is_single_byte(encoding)
+        self.slices = [(int(p0 - 1), int(p0 + pt - 1)) for p0, pt in column_mappings]
+
+        gather = []
+        widths = []
+        for start, end in self.slices:
+            positions = list(range(max(start, 0), min(end, record_length)))
+            # The last byte of every segment is blanked and later used as separator
+            gather += positions + [0]
+            widths.append(len(positions) + 1)
+
+        self.gather = np.array(gather, dtype=np.intp)
+        self.widths = np.array(widths, dtype=np.intp)
+        self.offsets = np.concatenate([[0], np.cumsum(self.widths)[:-1]]).astype(np.intp)
+        self.separators = self.offsets + self.widths - 1
+        # Smallest integer type able to hold the positions inside a segment
+        self.position_type = np.int8 if max(widths) < 127 else np.int32
+        self.local = (np.arange(len(gather)) - np.repeat(self.offsets, self.widths))\
+                    .astype(self.position_type)
+        # Segments of up to 32 bytes are reduced to bit masks, one bit per byte
+        self.weights = None
+        if max(widths) <= 32:
+            self.weights = np.uint32(1) << self.local.astype(np.uint32)
+
+    def strip(self, records, byte_classes=None):
+        '''
+        Gathers the columns of a 2-D array of records and strips their values. Returns the
+        gathered bytes, their byte classes and the start and end (exclusive) of each value
+        inside its segment.
+        '''
+        if byte_classes is None:
+            byte_classes = self.byte_classes
+        values = records[:, self.gather]
+        values[:, self.separators] = ord(' ')
+        classes = np.take(byte_classes, values)
+
+        start, end = self._bounds(classes & WHITESPACE == 0)
+        if (classes & DOT).any():
+            kept = classes & DOT == 0
+            kept &= self._inside(start, end)
+            start, end = self._bounds(kept)
+
+        if not self.single_byte:
+            self._strip_multibyte(values, start, end)
+        return values, classes, start, end
+
+    def _strip_multibyte(self, values, start, end):
+        '''
+        Strips again, one by one, the values with non ASCII bytes at their edges, which
+        may be whitespace in multi-byte encodings. start and end are updated in place.
+        '''
+        first = np.take_along_axis(values, self.offsets + start.astype(np.intp), axis=1)
+        last = np.take_along_axis(values, self.offsets + np.maximum(end - 1, 0).astype(np.intp),
+                                  axis=1)
+        rows, columns = np.nonzero((end > start) & ((first >= 0x80) | (last >= 0x80)))
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            offset = self.offsets[column]
+            value = values[row, offset:self.separators[column]].tobytes()
+            start[row, column], end[row, column] = strip_value(value, self.encoding)
+
+    def _bounds(self, kept):
+        '''First and last + 1 kept positions of each segment, (0, 0) if none is kept'''
+        if self.weights is not None:
+            # The positions are the lowest and highest bits set in the mask of each segment
+            bits = np.where(kept, self.weights, np.uint32(0))
+            bits = np.bitwise_or.reduceat(bits, self.offsets, axis=1)
+            end = np.frexp(bits)[1]
+            start = np.frexp(bits & (~bits + np.uint32(1)))[1] - 1
+            start[bits == 0] = 0
+            return start, end
+
+        start = np.minimum.reduceat(np.where(kept, self.local, np.iinfo(self.position_type).max),
+                                    self.offsets, axis=1)
+        end = np.maximum.reduceat(np.where(kept, self.local, -1), self.offsets, axis=1) + 1
+        empty = end == 0
+        start[empty] = 0
+        return start, end
+
+    def _inside(self, start, end):
+        '''Mask of the positions between start and end in each segment'''
+        start = np.repeat(start, self.widths, axis=1)
+        end = np.repeat(end, self.widths, axis=1)
+        return (self.local >= start) & (self.local < end)
+
+    def decode(self, records):
+        '''Returns a list with the values (bytes) of each column of a block of records'''
+        values, _, start, end = self.strip(records)
+        return self._extract(values, start, end)
+
+    def _extract(self, values, start, end):
+        '''Returns a list with the values (bytes) of each column given their boundaries'''
+        start = start.astype(np.intp)
+        lengths = end - start
+        columns = []
+        for i, (offset, width) in enumerate(zip(self.offsets, self.widths)):
+            # Shifts each value to the start of its segment and blanks the rest with nulls,
+            # which numpy drops from the end of byte strings
+            positions = np.arange(width)
+            column = values[:, offset:offset + width]
+            column = np.take_along_axis(column, np.minimum(positions + start[:, i, None],
+                                                           width - 1), axis=1)
+            column[positions >= lengths[:, i, None]] = 0
+            columns.append(column.view('S{}'.format(width)).ravel().tolist())
+        return columns
+
+    def to_csv(self, records, sep=b';'):
+        '''
+        Returns the csv lines of a block of records. Each value is written with its
+        separator in a single masked copy of the gathered bytes.
+        '''
+        if len(sep) != 1:
+            return columns_to_csv(self.decode(records), sep)
+
+        byte_classes = self.byte_classes.copy()
+        byte_classes[ord(sep)] |= QUOTED
+        values, classes, start, end = self.strip(records, byte_classes)
+        kept = self._inside(start, end)
+
+        quoted = classes & QUOTED
+        if quoted.any():
+            quoted[~kept] = 0
+            if quoted.any():
+                # Some values must be quoted, fall back to writing value by value
+                quoted = np.bitwise_or.reduceat(quoted, self.offsets, axis=1).astype(bool)
+                columns = self._extract(values, start, end)
+                return columns_to_csv(columns, sep, quoted.T)
+
+        values[:, self.separators] = ord(sep)
+        values[:, self.separators[-1]] = ord('\n')
+        kept[:, self.separators] = True
+        return values[kept].tobytes()
+
+def decode_lines(lines, slices, encoding=ENCODING):
+    '''
+    Decodes a list of lines (bytes) one by one. Used when records don't have a fixed length.
+    Returns a list with the values of each column.
+    '''
+    columns = []
+    for start, end in slices:
+        column = []
+        for line in lines:
+            value = line[start:end]
+            value_start, value_end = strip_value(value, encoding)
+            column.append(value[value_start:value_end])
+        columns.append(column)
+    return columns
+
+def _quote(value):
+    '''Quotes a csv value'''
+    return b'"' + value.replace(b'"', b'""') + b'"'
+
+def columns_to_csv(columns, sep=b';', quoted=None):
+    '''
+    Returns the csv lines of a list of columns. Values with separators, quotes or line breaks
+    are quoted, in the same way as csv.QUOTE_MINIMAL. quoted may be given as an array with
+    the values that need quotes, one row per column.
+    '''
+    special = sep + b'"\n\r'
+    quoted_columns = []
+    for i, column in enumerate(columns):
+        if quoted is None:
+            needs_quotes = [len(v.translate(None, special)) != len(v) for v in column]
+        elif quoted[i].any():
+            needs_quotes = quoted[i].tolist()
+        else:
+            quoted_columns.append(column)
+            continue
+        quoted_columns.append([_quote(v) if q else v for v, q in zip(column, needs_quotes)])
+    return b''.join(sep.join(row) + b'\n' for row in zip(*quoted_columns))
+
+def read_blocks(tabbed_file_name, chunk_size, record_length=None, start=0, end=None):
+    '''
+    Reads a tabbed file chunk_size records at a time. Yields tuples (records, lines): while
+    all records have the same length, records is a 2-D array with one record per row and
+    lines is None. If the record length changes along the file, the rest of it is yielded as
+    lists of lines instead.
+    Only the byte range [start, end) is read if given; it must be aligned to records.
+    '''
+    with open(tabbed_file_name, 'rb') as tabbed_file:
+        if record_length is None:
+            record_length = len(tabbed_file.readline())
+        tabbed_file.seek(start)
+        remaining = float('inf') if end is None else end - start
+        while record_length and remaining > 0:
+            block = tabbed_file.read(int(min(record_length * chunk_size, remaining)))
+            if not block:
+                return
+            block_length = len(block)
+            if not block.endswith(b'\n') and block_length < record_length * chunk_size:
+                # Last record without line break
+                block += b'\n'
+
+            records = None
+            if not len(block) % record_length:
+                records = np.frombuffer(block, dtype=np.uint8).reshape(-1, record_length)
+                if not (records[:, -1] == ord('\n')).all():
+                    records = None
+            if records is None:
+                logger.warning("Records of %s don't have a fixed length, decoding line by line",
+                               tabbed_file_name)
+                tabbed_file.seek(-block_length, 1)
+                break
+            remaining -= block_length
+            yield records, None
+
+        lines = []
+        for line in tabbed_file:
+            if remaining <= 0:
+                break
+            remaining -= len(line)
+            lines.append(line)
+            if len(lines) == chunk_size:
+                yield None, lines
+                lines = []
+        if lines:
+            yield None, lines
+
+def get_record_length(tabbed_file_name):
+    '''Returns the length of the first record of a tabbed file, line break included'''
+    with open(tabbed_file_name, 'rb') as tabbed_file:
+        return len(tabbed_file.readline())
+
+def iterate_columns(tabbed_file_name, column_mappings, chunk_size):
+    '''
+    Iterates over a tabbed file and yields, for each chunk of chunk_size records, a list with
+    the values (bytes) of each column.
+    '''
+    layout = TabbedLayout(column_mappings, get_record_length(tabbed_file_name))
+    for records, lines in read_blocks(tabbed_file_name, chunk_size):
+        if records is not None:
+            yield layout.decode(records)
+        else:
+            yield decode_lines(lines, layout.slices)
+
+def iterate_csv(tabbed_file_name, column_mappings, chunk_size, sep=';', start=0, end=None):
+    '''
+    Iterates over a tabbed file and yields the csv lines (bytes) of each chunk of chunk_size
+    records. Only the byte range [start, end) is converted if given.
+    '''
+    sep = sep.encode()
+    record_length = get_record_length(tabbed_file_name)
+    layout = TabbedLayout(column_mappings, record_length)
+    for records, lines in read_blocks(tabbed_file_name, chunk_size, record_length, start, end):
+        if records is not None:
+            yield layout.to_csv(records, sep)
+        else:
+            yield columns_to_csv(decode_lines(lines, layout.slices), sep)
+
+def _range_to_csv(arguments):
+    '''Converts a byte range of a tabbed file, used by the worker processes'''
+    tabbed_file_name, column_mappings, chunk_size, sep, start, end = arguments
+    return b''.join(iterate_csv(tabbed_file_name, column_mappings, chunk_size, sep, start, end))
+
+def iterate_csv_parallel(tabbed_file_name, column_mappings, chunk_size, workers, sep=';',
+                         max_pending=None):
+    '''
+    Same as iterate_csv, but the file is split in ranges of about chunk_size records that are
+    converted by a pool of workers processes. Ranges are yielded in the order of the file.
+    At most max_pending ranges (twice the workers by default) are converted ahead of the
+    consumer, so converted ranges don't pile up in memory when it is slower than the workers.
+    '''
+    if max_pending is None:
+        max_pending = 2 * workers
+    range_size = get_record_length(tabbed_file_name) * chunk_size
+    arguments = [(tabbed_file_name, column_mappings, chunk_size, sep, start, end)
+                 for start, end in streams.split_ranges(tabbed_file_name, range_size)]
+    logger.info('Converting %s in %d ranges with %d workers', tabbed_file_name, len(arguments),
+                workers)
+
+    pending = deque()
+    with Pool(workers) as pool:
+        for argument in arguments:
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_range_to_csv, (argument,)))
+        while pending:
+            yield pending.popleft().get()
+
+def csv_fifo(tabbed_file_name, column_mappings, chunk_size, sep=';', workers=1):
+    '''
+    Returns a context manager that creates a named pipe fed with the csv lines of a tabbed
+    file (without header), and yields its path. See streams.fifo.
+    '''
+    if workers > 1:
+        chunks = iterate_csv_parallel(tabbed_file_name, column_mappings, chunk_size, workers, sep)
+    else:
+        chunks = iterate_csv(tabbed_file_name, column_mappings, chunk_size, sep)
+
+    return streams.fifo(chunks, os.path.basename(tabbed_file_name) + '.csv')
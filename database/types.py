@@ -19,6 +19,7 @@ along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import re
+from datetime import date
 from sqlalchemy_monetdb.monetdb_types import MONETDB_TYPE_MAP, TINYINT, DOUBLE_PRECISION
 from sqlalchemy.ext.compiler import compiles
 
@@ -26,6 +27,15 @@ from sqlalchemy.ext.compiler import compiles
 TYPE_RE = re.compile('[a-z]+')
 ARGS_RE = re.compile('\\( *[0-9,.]+ *\\)')
 
+# Patterns of values accepted by COPY for inferred types. Integers with leading zeros are
+# codes, which must keep their zeros.
+INTEGER_RE = re.compile('-?(0|[1-9][0-9]*)')
+DIGITS_RE = re.compile('-?[0-9]+')
+DECIMAL_RE = re.compile('-?[0-9]+\\.[0-9]+')
+DATE_RE = re.compile('[0-9]{4}-[0-9]{2}-[0-9]{2}')
+INTEGER_TYPES = [('TINYINT', 127), ('SMALLINT', 32767), ('INT', 2**31 - 1), ('BIGINT', 2**63 - 1)]
+FALLBACK_TYPE = 'VARCHAR(255)'
+
 MONETDB_TYPE_MAP['integer'] = MONETDB_TYPE_MAP['int']
 
 @compiles(TINYINT)
@@ -74,3 +84,47 @@ def get_type(in_string):
     else:
         field_type = field_type()
     return field_type
+
+def infer_type(values, null=''):
+    '''
+    Returns the narrowest type string able to hold a sample of csv values. Integer types
+    leave room for values twice as large as the sampled ones, since the rest of the file
+    is unknown. Columns without values, or with values of mixed types, fall back to
+    VARCHAR(255).
+    '''
+    values = [value for value in values if value != null]
+    if not values:
+        return FALLBACK_TYPE
+    if all(INTEGER_RE.fullmatch(value) for value in values):
+        largest = 2 * max(abs(int(value)) for value in values)
+        for type_name, limit in INTEGER_TYPES:
+            if largest <= limit:
+                return type_name
+    elif all(INTEGER_RE.fullmatch(value) or DECIMAL_RE.fullmatch(value) for value in values):
+        return 'DOUBLE'
+    elif all(is_date(value) for value in values):
+        return 'DATE'
+    return FALLBACK_TYPE
+
+def is_date(value):
+    '''Whether value is an existing calendar date in the YYYY-MM-DD format'''
+    if not DATE_RE.fullmatch(value):
+        return False
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+def fits_type(value, type_name, null=''):
+    '''Whether a csv value can be loaded into a column of a type chosen by infer_type'''
+    if value == null or type_name == FALLBACK_TYPE:
+        return True
+    for integer_type, limit in INTEGER_TYPES:
+        if type_name == integer_type:
+            return bool(DIGITS_RE.fullmatch(value)) and abs(int(value)) <= limit
+    if type_name == 'DOUBLE':
+        return bool(DIGITS_RE.fullmatch(value) or DECIMAL_RE.fullmatch(value))
+    if type_name == 'DATE':
+        return is_date(value)
+    return True
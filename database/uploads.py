@@ -0,0 +1,100 @@
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+''' Client side transfer of files for COPY ... ON CLIENT queries. The server requests the
+file to the client, which sends it through the database connection, so data can be loaded
+from hosts other than the database server.'''
+import logging
+import shutil
+
+from pymonetdb import Uploader
+
+from database.base import DatabaseError
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+class FileUploader(Uploader):
+    '''
+    Serves upload requests from the server. Only files added to the uploader are sent, each
+    of them once. Files are read from disk, unless an iterable of bytes chunks is given for
+    them.
+    '''
+    def __init__(self, chunk_size=settings.UPLOAD_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._files = {}
+
+    def add_file(self, file_name, chunks=None):
+        '''Allows the server to request file_name. Files already added are kept.'''
+        self._files.setdefault(file_name, chunks)
+
+    def handle_upload(self, upload, filename, text_mode, skip_amount):
+        if filename not in self._files:
+            logger.error("Server requested file %s, which wasn't added for upload", filename)
+            upload.send_error('Forbidden')
+            return
+
+        chunks = self._files.pop(filename)
+        logger.info("Uploading %s", filename)
+        upload.set_chunk_size(self.chunk_size)
+        writer = upload.binary_writer()
+        if chunks is None:
+            with open(filename, 'rb') as in_file:
+                for _ in range(skip_amount):
+                    in_file.readline()
+                shutil.copyfileobj(in_file, writer, self.chunk_size)
+        else:
+            for chunk in skip_lines(chunks, skip_amount):
+                if upload.is_cancelled():
+                    break
+                writer.write(chunk)
+        writer.close()
+
+def skip_lines(chunks, amount):
+    '''Skips the first amount lines of an iterable of bytes chunks'''
+    chunks = iter(chunks)
+    for chunk in chunks:
+        while amount and chunk:
+            position = chunk.find(b'\n')
+            if position < 0:
+                chunk = b''
+            else:
+                chunk = chunk[position + 1:]
+                amount -= 1
+        if chunk:
+            yield chunk
+        if not amount:
+            break
+    yield from chunks
+
+def get_uploader(connection):
+    '''
+    Returns the FileUploader of a sqlalchemy connection, setting it up at the first call.
+    '''
+    dbapi_connection = connection.connection.connection
+    uploader = getattr(dbapi_connection, 'hotmapper_uploader', None)
+    if uploader is None:
+        if not hasattr(dbapi_connection, 'set_uploader'):
+            raise DatabaseError('Client side COPY requires pymonetdb 1.6 or newer')
+        uploader = FileUploader()
+        dbapi_connection.set_uploader(uploader)
+        dbapi_connection.hotmapper_uploader = uploader
+    return uploader
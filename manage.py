@@ -24,16 +24,57 @@ along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
 from manager import Manager
 import subprocess
 import database.actions
-from settings import SCRIPTS_FOLDER
+from settings import SCRIPTS_FOLDER, REMAP_BATCH_SIZE
 
 manager = Manager()
 
 @manager.command
-def insert(csv_file, table, year, sep=';', null='',notifybackup=None):
-    '''Inserts file in table using a year as index'''
-    database.actions.insert(csv_file, table, year, delimiters=[sep, '\\n', '"'], null=null)
+def insert(csv_file, table, year, sep=';', null='',notifybackup=None, client=False, workers=1,
+           prune=False, on_conflict=None):
+    '''Inserts file in table using a year as index.
+    If client is set, the file is sent through the connection, so the database can be remote.
+    If workers is greater than 1, the file is split and copied in parallel by that many
+    connections. If prune is set, columns not used by the protocol are not loaded.
+    on_conflict (skip, update or replace) handles rows whose key is already in the table'''
+    database.actions.insert(csv_file, table, year, delimiters=[sep, '\\n', '"'], null=null,
+                            client=client, workers=int(workers), prune=prune,
+                            on_conflict=on_conflict)
     if notifybackup:
         database.actions.generate_backup()
+
+@manager.command
+def replace_year(csv_file, table, year, sep=';', null='', notifybackup=None, client=False,
+                 workers=1, prune=False):
+    '''Replaces the data of a year in table with the contents of a file, atomically.'''
+    database.actions.replace_year(csv_file, table, year, delimiters=[sep, '\\n', '"'],
+                                  null=null, client=client, workers=int(workers), prune=prune)
+    if notifybackup:
+        database.actions.generate_backup()
+
+@manager.command
+def insert_many(manifest, table, workers=4, sep=';', null='', notifybackup=None, client=False,
+                prune=False, on_conflict=None):
+    '''Inserts the files listed in a manifest, one "file;year" pair per line, in table.
+    Files are loaded concurrently by up to workers database connections.
+    If prune is set, columns not used by the protocol are not loaded.
+    on_conflict (skip, update or replace) handles rows whose key is already in the table'''
+    database.actions.insert_many(manifest, table, workers=int(workers),
+                                 delimiters=[sep, '\\n', '"'], null=null, client=client,
+                                 prune=prune, on_conflict=on_conflict)
+    if notifybackup:
+        database.actions.generate_backup()
+
+@manager.command
+def insert_tabbed(tabbed_file, table, year, sep=';', null='', workers=1, notifybackup=None,
+                  client=False):
+    '''Inserts a tabbed file in table using a year as index, without an intermediate csv.
+    The database server must be able to read files from this host, unless client is set.
+    If workers is greater than 1, the file is decoded by that many processes'''
+    database.actions.insert_tabbed(tabbed_file, table, year, sep=sep, null=null,
+                                   workers=int(workers), client=client)
+    if notifybackup:
+        database.actions.generate_backup()
+
 @manager.command
 def create(table, ignore_definitions=False):
     '''Creates table using mapping protocols
@@ -47,26 +88,37 @@ def drop(table):
     database.actions.drop(table)
 
 @manager.command
-def remap(table, auto_confirmation=False, verify_definitions=False):
+def remap(table, auto_confirmation=False, verify_definitions=False, strategy='auto',
+          online=False, workers=1, batch_size=REMAP_BATCH_SIZE, resume=False):
     '''Restructures a table to match the mapping protocol.
     If auto_confirmation is set it will not ask before doing any operation
-    If verify_definitions is set it will ask any difference between mapping_protocol and table_definition'''
-    database.actions.remap(table, auto_confirmation, verify_definitions)
+    If verify_definitions is set it will ask any difference between mapping_protocol and table_definition
+    strategy (columns, rebuild or auto) sets how changed columns are updated.
+    If online is set, the table stays readable while a remapped copy is built by workers
+    connections, and the copy replaces it at the end
+    Columns updated one by one are committed every batch_size rows (0 for a single
+    transaction). If resume is set, an interrupted transfer is finished first'''
+    database.actions.remap(table, auto_confirmation, verify_definitions, strategy,
+                           online, int(workers), int(batch_size), resume)
 
 @manager.command
 def update_from_file(csv_file, table, year, columns=None, target_list=None, offset=2, sep=';',
-                     null=''):
+                     null='', client=False, workers=1, prune=False):
     if columns:
         columns = columns.split(',')
     if target_list:
         target_list = target_list.split(',')
     database.actions.update_from_file(csv_file, table, year, columns=columns,
                                       offset=offset,
-                                      delimiters=[sep, '\\n', '"'], null=null)
+                                      delimiters=[sep, '\\n', '"'], null=null, client=client,
+                                      workers=int(workers), prune=prune)
 
 @manager.command
-def csv_from_tabbed(table_name, input_file, output_file, year, sep=';'):
-    database.actions.csv_from_tabbed(table_name, input_file, output_file, year, sep=';')
+def csv_from_tabbed(table_name, input_file, output_file, year, sep=';', workers=1):
+    '''Converts a tabbed file to csv using the positions from the mapping protocol.
+    If workers is greater than 1, the file is split and converted by that many processes'''
+    database.actions.csv_from_tabbed(table_name, input_file, output_file, year, sep=sep,
+                                     workers=int(workers))
 
 @manager.command
 def update_denormalized(table_name, year):
@@ -76,6 +128,11 @@ def update_denormalized(table_name, year):
 def run_aggregations(table_name, year):
     database.actions.run_aggregations(table_name, year)
 
+@manager.command
+def explain_derivatives(table, year):
+    '''Prints the derivatives of a year, grouped by the UPDATE pass that computes them'''
+    database.actions.explain_derivatives(table, year)
+
 @manager.command
 def generate_backup():
     '''Create/Recriate file monitored by backup script in production'''
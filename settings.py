@@ -29,7 +29,7 @@ DATABASE_USER = 'monetdb'
 DATABASE_USER_PASSWORD = 'monetdb'
 
 # Host to connect to. Bulk inserts won't work remotely unless you can specify an
-# absolute path in the server
+# absolute path in the server, or use the --client option to send files through the connection
 DATABASE_HOST = 'localhost'
 
 # Database to connect to
@@ -48,6 +48,10 @@ BACKUP_FILE = 'backupdadoseducacionais'
 # Folder where mapping protocols can be found - relative to root
 MAPPING_PROTOCOLS_FOLDER = 'mapping_protocols'
 
+# If set to True, compiled mapping protocols are cached next to their csv files and reused
+# while the csv is unchanged
+PROTOCOL_CACHE = True
+
 # Folder for table definitions files
 TABLE_DEFINITIONS_FOLDER = 'table_definitions'
 
@@ -70,3 +74,21 @@ LOGGING_FORMAT = "%(levelname)s - %(name)s: %(message)s"
 
 # Info used on file format conversions
 CHUNK_SIZE = 500
+
+# Amount of lines sampled from input files to choose the types of unmapped columns used by
+# derivatives in temporary tables. If set to 0, those columns are created as VARCHAR(255).
+# Loading a file with values that don't fit the inferred types fails, naming their column
+TYPE_INFERENCE_ROWS = 0
+
+# Remap rebuilds the whole table, instead of changing columns one by one, when at least this
+# fraction of its columns change
+REMAP_REBUILD_RATIO = 0.3
+
+# Rows copied per transaction when remap transfers changed columns one by one. Progress is
+# recorded in the checkpoint table, so interrupted transfers can be resumed with --resume.
+# If set to 0, the default, each transfer runs in a single transaction
+REMAP_BATCH_SIZE = 0
+REMAP_CHECKPOINT_TABLE = 'remap_checkpoint'
+
+# Size in bytes of the blocks sent to the server when files are copied from the client
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
@@ -22,13 +22,18 @@ along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
 
 '''Describes tests for the database.database_table module, concerning DatabaseTable objects
 and their manipulation'''
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock, call
 import string
 import json
+from io import StringIO
 from random import choice, randint
 import sqlalchemy
-from sqlalchemy import MetaData, text, Column, Integer, PrimaryKeyConstraint
+from sqlalchemy import MetaData, text, select, Column, Integer, PrimaryKeyConstraint, \
+    ForeignKeyConstraint
+from sqlalchemy_monetdb.dialect import MonetDialect
 
 import database.base as base
 import database.database_table as database_table
@@ -182,7 +187,7 @@ class DatabaseTableTest(unittest.TestCase):
         self.table.create_mapping_table()
         self.table._mapping_table.create.assert_not_called()
 
-        self.engine.connect.assert_called_once()
+        self.engine.connect.assert_not_called()
         mocked_insert.assert_called_with(self.table._mapping_table)
 
         self.table._mapping_table.exists.return_value = False
@@ -298,6 +303,25 @@ class DatabaseTableTest(unittest.TestCase):
         mocked_column.assert_called()
         self.engine.execute.assert_called()
 
+    def test_add_drop_columns(self):
+        '''Columns must be mapped and altered in a single round trip each'''
+        self.table._mapping_table.exists = MagicMock(self.table._mapping_table.exists)
+        self.table._mapping_table.exists.return_value = True
+        columns = [('c{}'.format(i), 'INT', 'T{}'.format(i)) for i in range(400)]
+
+        self.table.add_columns(columns)
+        self.assertEqual(self.engine.execute.call_count, 2)
+        self.assertEqual(len(self.engine.execute.call_args_list[0][0][1]), 400)
+        self.assertEqual(self.engine.execute.call_args_list[1][0][0].count('add column'), 400)
+        self.assertEqual(len(self.table.columns), 400)
+
+        self.engine.execute.reset_mock()
+        self.table.drop_columns([(name, target) for name, _, target in columns])
+        self.assertEqual(self.engine.execute.call_count, 2)
+        self.assertEqual(self.engine.execute.call_args_list[1][0][0].count('drop column'), 400)
+        self.table._mapping_table.exists.assert_called_with(bind=self.engine)
+        self.assertEqual(len(self.table.columns), 0)
+
     @patch('database.database_table.get_type')
     @patch('database.database_table.Column')
     @patch('database.database_table.update')
@@ -371,6 +395,125 @@ class DatabaseTableTest(unittest.TestCase):
         self.table.redefine_column.assert_has_calls(calls, any_order=True)
         mocked_column.assert_has_calls(column_calls)
 
+    def test_rebuild(self):
+        '''The table must be rebuilt with every change and have its constraints recreated'''
+        for column in ['id', 'nome', 'idade', 'velho']:
+            self.table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        connection = MagicMock()
+        connection.dialect = MonetDialect()
+        self.table.drop_columns([('velho', None)], bind=connection)
+        connection.execute.reset_mock()
+
+        self.table.rebuild(connection, [{'name': 'nome', 'new_name': 'nome_aluno',
+                                         'new_type': 'VARCHAR(64)'},
+                                        {'name': 'idade', 'new_name': 'idade',
+                                         'new_type': 'TINYINT'}])
+
+        queries = [str(c[0][0].compile(dialect=connection.dialect))
+                   for c in connection.execute.call_args_list]
+        self.assertTrue(queries[0].startswith('CREATE TABLE {}_rebuild AS'.format(self.name)))
+        self.assertIn('CAST({}.nome AS VARCHAR(64)) AS nome_aluno'.format(self.name), queries[0])
+        self.assertNotIn('velho', queries[0])
+        self.assertEqual(queries[1:4], ['DROP TABLE {}'.format(self.name),
+                                        'ALTER TABLE {0}_rebuild RENAME TO {0}'.format(self.name),
+                                        'ALTER TABLE {} ADD PRIMARY KEY (id)'.format(self.name)])
+        self.assertCountEqual(self.table.columns.keys(), ['id', 'nome_aluno', 'idade'])
+        connection.begin.assert_not_called()
+
+        connection.in_transaction.return_value = False
+        with self.assertRaises(base.DatabaseError):
+            self.table.rebuild(connection, [{'name': 'idade', 'new_name': 'idade',
+                                             'new_type': 'INT'}])
+
+    def test_choose_remap_strategy(self):
+        '''Tables must be rebuilt when many columns change, unless a rebuild loses objects'''
+        for i in range(10):
+            self.table.append_column(Column('c{}'.format(i), Integer))
+        self.table.get_rebuild_losses = MagicMock(return_value=[])
+
+        self.assertEqual(self.table.choose_remap_strategy([{}] * 2), 'columns')
+        self.table.get_rebuild_losses.assert_not_called()
+        self.assertEqual(self.table.choose_remap_strategy([{}] * 3), 'rebuild')
+        self.table.get_rebuild_losses.return_value = ['index idx']
+        self.assertEqual(self.table.choose_remap_strategy([{}] * 3), 'columns')
+
+    def test_get_rebuild_losses(self):
+        '''Defaults, NOT NULL columns, unique constraints and indexes are lost by rebuilds'''
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+        engine.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, a INTEGER)'.format(self.name))
+        self.assertEqual(table.get_rebuild_losses(), [])
+
+        engine.execute('DROP TABLE {}'.format(self.name))
+        engine.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, a INTEGER NOT NULL, '
+                       'b INTEGER DEFAULT 1, c INTEGER, d INTEGER, CONSTRAINT u UNIQUE (c))'
+                       .format(self.name))
+        engine.execute('CREATE INDEX i ON {} (d)'.format(self.name))
+        self.assertEqual(table.get_rebuild_losses(), ['NOT NULL of a', 'default of b',
+                                                      'unique constraint u', 'index i'])
+
+    def test_remap_online(self):
+        '''The shadow table must be backfilled by key ranges and swapped with the table'''
+        queries = []
+        def execute(query, *args):
+            queries.append(str(query.compile(dialect=self.engine.dialect)))
+            return MagicMock()
+        self.engine.dialect = MonetDialect()
+        self.engine.execute.side_effect = execute
+        self.engine.execute.return_value.fetchone.return_value = (1, 100)
+        connection = self.engine.connect.return_value.__enter__.return_value
+        connection.execute.side_effect = execute
+        for column in ['id', 'nome', 'velho']:
+            self.table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        self.table.is_referenced = MagicMock(return_value=False)
+        self.table._backfill = MagicMock(self.table._backfill)
+        # Neither the shadow nor the old table exist
+        self.engine.run_callable.return_value = False
+
+        self.table.remap_online([('nova', 'INT', 'NOVA')], [('velho', 'VELHO')],
+                                [{'name': 'nome', 'new_name': 'nome_aluno',
+                                  'new_type': 'VARCHAR(64)'}], workers=2)
+
+        self.assertTrue(queries[0].startswith('CREATE TABLE {}_shadow AS'.format(self.name)))
+        self.assertTrue(queries[0].endswith('WITH NO DATA'))
+        self.assertNotIn('velho', queries[0])
+        self.table._backfill.assert_called_once()
+        self.assertEqual(queries[1:4], [
+            'ALTER TABLE {}_shadow ADD PRIMARY KEY (id)'.format(self.name),
+            'ALTER TABLE {0} RENAME TO {0}_old'.format(self.name),
+            'ALTER TABLE {0}_shadow RENAME TO {0}'.format(self.name)])
+        self.assertEqual(queries[-1], 'DROP TABLE {}_old'.format(self.name))
+        self.assertCountEqual(self.table.columns.keys(), ['id', 'nome_aluno', 'nova'])
+
+        self.engine.run_callable.return_value = True
+        with self.assertRaises(base.DatabaseError):
+            self.table.remap_online([], [], [])
+        self.table.is_referenced.return_value = True
+        with self.assertRaises(base.DatabaseError):
+            self.table.remap_online([], [], [])
+
+    def test_backfill(self):
+        '''Every row must be copied, split in key ranges copied by their own connections'''
+        with tempfile.TemporaryDirectory() as directory:
+            # A file, so the connections of the workers share the database
+            engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(directory, 'db'))
+            table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+            for column in ['id', 'nome']:
+                table.append_column(Column(column, Integer, primary_key=column == 'id'))
+            table.metadata.create_all(engine)
+            engine.execute(table.insert(), [{'id': i, 'nome': i * 10} for i in range(1, 101)])
+
+            shadow, projection, _ = table._get_remapped_table(
+                self.name + '_shadow', [{'name': 'nome', 'new_name': 'nome_aluno',
+                                         'new_type': 'VARCHAR(10)'}])
+            shadow.create(bind=engine)
+            with patch.object(engine, 'connect', wraps=engine.connect) as connect:
+                table._backfill(shadow, projection, 3)
+            self.assertEqual(connect.call_count, 3)
+            self.assertEqual(engine.execute(select([shadow]).order_by(shadow.c.id)).fetchall(),
+                             [(i, str(i * 10)) for i in range(1, 101)])
+            engine.dispose()
+
     def test_compare_mapping(self):
         '''Tests the compare_mapping method that compares mapping_table information with
            a mapping protocol'''
@@ -380,13 +523,351 @@ class DatabaseTableTest(unittest.TestCase):
         p = protocol.Protocol()
         self.table.load_protocol(p)
 
+    def test_compare_mapping_wide(self):
+        '''Remap planning of wide tables must take a single query'''
+        columns = 3000
+        definitions = MagicMock()
+        definitions.columns = {'c{}'.format(i): ['INT', 'T{}'.format(i)] for i in range(columns)}
+        definitions.columns['c7'] = ['VARCHAR(10)', 'T7']
+        definitions.columns['renamed'] = definitions.columns.pop('c8')
+        definitions.get_targets.return_value = [p[1] for p in definitions.columns.values()]
+        self.table._definitions = definitions
+        self.engine.execute.return_value.fetchall.return_value = \
+            [('T{}'.format(i), 'c{}'.format(i), 'INTEGER') for i in range(1, columns + 1)]
+
+        new_columns, to_drop_columns, update_columns = self.table.compare_mapping()
+
+        self.engine.execute.assert_called_once()
+        self.assertEqual(new_columns, ['T0'])
+        self.assertEqual(to_drop_columns, ['T{}'.format(columns)])
+        self.assertCountEqual(update_columns, [
+            {'name': 'c7', 'new_name': 'c7', 'new_type': 'VARCHAR(10)'},
+            {'name': 'c8', 'new_name': 'renamed', 'new_type': 'INTEGER'}])
+
     def test_insert_from_temporary(self):
         '''Tests insertion in table from a previously created temporary table'''
         pass
 
+    def test_get_fused_select(self):
+        '''Derivatives inlined in the insert must give the same rows as apply_derivatives'''
+        protocol_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015
+ID,id,Id,0,id,INT,NU_ID
+IDADE,idade,Idade,0,idade,INT,NU_IDADE
+FAIXA,faixa,Faixa,0,faixa,INT,"~CASE WHEN ""IDADE"" < 18 THEN 1 ELSE 2 END"
+DOBRO,dobro,Dobro,0,dobro,INT,~FAIXA * 2 + IDADE
+'''
+        results = []
+        for fused in [False, True]:
+            engine = sqlalchemy.create_engine('sqlite://')
+            table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+            for column in ['id', 'idade', 'faixa', 'dobro']:
+                table.append_column(Column(column, Integer, primary_key=column == 'id'))
+            table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+            table.metadata.create_all(engine)
+
+            ttable = table.get_temporary(['NU_ID', 'NU_IDADE'], '2015')
+            ttable.schema = None
+            ttable._prefixes = []
+            ttable.create(bind=engine)
+            engine.execute(ttable.insert(), [{'id': i, 'idade': i * 5} for i in range(10)])
+            if fused:
+                table.insert_from_temporary(ttable, year='2015')
+            else:
+                table.apply_derivatives(ttable, ttable.columns.keys(), '2015')
+                table.insert_from_temporary(ttable)
+            results.append(engine.execute(select([table]).order_by(table.c.id)).fetchall())
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][4], (4, 20, 2, 24))
+
+    def test_denormalize(self):
+        '''Only rows of the year with a referenced row must take the referenced values'''
+        engine = sqlalchemy.create_engine('sqlite://')
+        meta = MetaData(bind=engine)
+        escola = sqlalchemy.Table('escola', meta, Column('ano_censo', Integer, primary_key=True),
+                                  Column('id', Integer, primary_key=True),
+                                  Column('dependencia', Integer))
+        table = database_table.DatabaseTable(self.name, meta)
+        for column in ['id', 'ano_censo', 'escola_id', 'dependencia']:
+            table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        table.append_constraint(ForeignKeyConstraint(['ano_censo', 'escola_id'],
+                                                     ['escola.ano_censo', 'escola.id']))
+        meta.create_all(engine)
+        engine.execute(escola.insert(), [{'ano_censo': 2015, 'id': 1, 'dependencia': 3},
+                                         {'ano_censo': 2016, 'id': 2, 'dependencia': 4}])
+
+        ttable = sqlalchemy.Table('temporary', MetaData(),
+                                  *[Column(c.name, c.type, primary_key=c.primary_key)
+                                    for c in table.columns])
+        ttable.create(bind=engine)
+        engine.execute(ttable.insert(), [
+            {'id': 0, 'ano_censo': 2015, 'escola_id': 1, 'dependencia': None},
+            {'id': 1, 'ano_censo': 2015, 'escola_id': 9, 'dependencia': 7},
+            {'id': 2, 'ano_censo': 2016, 'escola_id': 2, 'dependencia': 8}])
+
+        staging = table._denormalize(ttable, [(['dependencia'], '~escola.dependencia')], 2015,
+                                     engine)
+        self.assertEqual(list(ttable.metadata.tables), ['temporary_denormalized'])
+        self.assertIs(ttable.metadata.tables['temporary_denormalized'], staging)
+        self.assertEqual(engine.execute(select([staging.c.id, staging.c.dependencia])
+                                        .order_by(staging.c.id)).fetchall(),
+                         [(0, 3), (1, 7), (2, 8)])
+        self.assertNotIn('temporary', sqlalchemy.inspect(engine).get_table_names())
+
+    def test_get_fused_select_denormalized(self):
+        '''Rows without a referenced row must keep their values in the fused insert too'''
+        protocol_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015
+ID,id,Id,0,id,INT,NU_ID
+ANO,ano_censo,Ano,0,ano_censo,INT,NU_ANO
+ESCOLA,escola_id,Escola,0,escola_id,INT,CO_ESCOLA
+DEP,dependencia,Dependência,0,dependencia,INT,~escola.dependencia
+DOBRO,dobro,Dobro,0,dobro,INT,~DEP * 2
+'''
+        results = []
+        for fused in [False, True]:
+            engine = sqlalchemy.create_engine('sqlite://')
+            meta = MetaData(bind=engine)
+            escola = database_table.DatabaseTable('escola', meta)
+            for column in ['ano_censo', 'id', 'dependencia']:
+                escola.append_column(Column(column, Integer,
+                                            primary_key=column != 'dependencia'))
+            table = database_table.DatabaseTable(self.name, meta)
+            for column in ['id', 'ano_censo', 'escola_id', 'dependencia', 'dobro']:
+                table.append_column(Column(column, Integer, primary_key=column == 'id'))
+            table.append_constraint(ForeignKeyConstraint(['ano_censo', 'escola_id'],
+                                                         ['escola.ano_censo', 'escola.id']))
+            table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+            meta.create_all(engine)
+            engine.execute(escola.insert(), [{'ano_censo': 2015, 'id': 1, 'dependencia': 3}])
+
+            ttable = table.get_temporary(['NU_ID', 'NU_ANO', 'CO_ESCOLA'], '2015')
+            ttable.schema = None
+            ttable._prefixes = []
+            ttable.create(bind=engine)
+            engine.execute(ttable.insert(), [
+                {'id': 0, 'ano_censo': 2015, 'escola_id': 1, 'dependencia': None},
+                {'id': 1, 'ano_censo': 2015, 'escola_id': 9, 'dependencia': 7}])
+            if fused:
+                table.insert_from_temporary(ttable, year='2015')
+            else:
+                ttable = table.apply_derivatives(ttable, ttable.columns.keys(), '2015')
+                table.insert_from_temporary(ttable)
+            results.append(engine.execute(select([table]).order_by(table.c.id)).fetchall())
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1], [(0, 2015, 1, 3, 6), (1, 2015, 9, 7, 14)])
+
+    def test_populate_temporary_prune(self):
+        '''Columns neither mapped nor used by derivatives must be skipped by the COPY'''
+        protocol_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015
+ID,id,Id,0,id,INT,NU_ID
+FAIXA,faixa,Faixa,0,faixa,INT,"~CASE WHEN ""NU_IDADE"" < 18 THEN 1 ELSE 2 END"
+'''
+        table = database_table.DatabaseTable(self.name, MetaData())
+        table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+        header = ['NU_ID', 'NU_IDADE', 'TX_UNUSED']
+        ttable = table.get_temporary(header, '2015', prune=True)
+        self.assertEqual(list(ttable.columns.keys()), ['id', 'faixa', 'NU_IDADE'])
+
+        bind = MagicMock()
+        query = table.populate_temporary(ttable, 'data.csv', header, '2015', bind=bind)
+        self.assertIn('{}("id", "NU_IDADE") '.format(ttable.name), str(query))
+        self.assertIn('\'data.csv\'("id", "NU_IDADE", "TX_UNUSED")', str(query))
+        bind.execute.assert_called_once_with(query)
+
+    def test_get_derivative_graph(self):
+        '''Graphs are compiled once for each protocol version, ordered by dependency'''
+        protocol_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015
+ID,id,Id,0,id,INT,NU_ID
+IDADE,idade,Idade,0,idade,INT,NU_IDADE
+FAIXA,faixa,Faixa,0,faixa,INT,"~CASE WHEN ""IDADE"" < 18 THEN 1 ELSE 2 END"
+DOBRO,dobro,Dobro,0,dobro,INT,~FAIXA * 2 + IDADE
+'''
+        table = database_table.DatabaseTable(self.name, MetaData())
+        table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+        graph = table.get_derivative_graph('2015')
+        self.assertIs(table.get_derivative_graph('2015'), graph)
+
+        self.assertEqual(graph.levels, [(1, ['FAIXA']), (2, ['DOBRO'])])
+        self.assertEqual(graph.edges['DOBRO'], ['FAIXA'])
+        self.assertEqual(list(graph.select({'faixa'})), ['FAIXA'])
+        self.assertEqual(sorted(graph.select({'dobro'})), ['DOBRO', 'FAIXA'])
+        self.assertIn('2 UPDATE pass(es)', graph.explain())
+
+        protocol_csv += 'NOVA,nova,Nova,0,nova,INT,~IDADE + 1\n'
+        table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+        self.assertEqual(table.get_derivative_graph('2015').levels,
+                         [(1, ['FAIXA', 'NOVA']), (2, ['DOBRO'])])
+
+    def test_prepare_years(self):
+        '''Once years are prepared, their plans and graphs must not change the protocol'''
+        protocol_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015,2016
+ID,id,Id,0,id,INT,NU_ID,NU_ID
+IDADE,idade,Idade,0,idade,INT,NU_IDADE,NU_IDADE
+IDADE2,idade2,Idade,0,idade2,INT,NU_IDADE,NU_IDADE
+DOBRO,dobro,Dobro,0,dobro,INT,~IDADE * 2,~IDADE2 * 2
+'''
+        table = database_table.DatabaseTable(self.name, MetaData())
+        table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+        table.prepare_years(['2015', '2016'])
+        fingerprint = table._protocol.fingerprint()
+        graphs = [table.get_derivative_graph(year) for year in ['2015', '2016']]
+
+        for year, graph in zip(['2016', '2015'], reversed(graphs)):
+            table._protocol.year_plan(year)
+            self.assertIs(table.get_derivative_graph(year), graph)
+        self.assertEqual(table._protocol.fingerprint(), fingerprint)
+        self.assertIn('IDADE2', graphs[1].derivatives)
+        self.assertNotIn('IDADE2', graphs[0].select({'dobro'}))
+
+    def test_insert_on_conflict(self):
+        '''Rows already in the table must be skipped, updated or replaced'''
+        protocol_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015
+ID,id,Id,0,id,INT,NU_ID
+IDADE,idade,Idade,0,idade,INT,NU_IDADE
+DOBRO,dobro,Dobro,0,dobro,INT,~IDADE * 2
+'''
+        expected = {
+            'skip': [(0, 0, 0), (1, 1, 2), (2, 20, 40), (3, 30, 60)],
+            'update': [(0, 0, 0), (1, 10, 20), (2, 20, 40), (3, 30, 60)],
+            'replace': [(0, None, None), (1, 10, 20), (2, 20, 40), (3, 30, 60)],
+        }
+        for mode, rows in expected.items():
+            engine = sqlalchemy.create_engine('sqlite://')
+            table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+            for column in ['id', 'idade', 'dobro']:
+                table.append_column(Column(column, Integer, primary_key=column == 'id'))
+            table.load_protocol(protocol.Protocol(StringIO(protocol_csv)))
+            table.metadata.create_all(engine)
+            engine.execute(table.insert(), [{'id': 0, 'idade': 0, 'dobro': 0},
+                                            {'id': 1, 'idade': 1, 'dobro': 2}])
+
+            ttable = table.get_temporary(['NU_ID', 'NU_IDADE'], '2015')
+            ttable.schema = None
+            ttable._prefixes = []
+            ttable.create(bind=engine)
+            engine.execute(ttable.insert(), [{'id': i, 'idade': i * 10} for i in range(1, 4)])
+            if mode == 'replace':
+                engine.execute(ttable.insert(), [{'id': 0}])
+            inserted = table.insert_from_temporary(ttable, year='2015', on_conflict=mode)
+
+            self.assertEqual(engine.execute(select([table]).order_by(table.c.id)).fetchall(),
+                             rows, mode)
+            self.assertEqual(inserted, 4 if mode == 'replace' else 2)
+
+        with self.assertRaises(base.DatabaseError):
+            table.insert_from_temporary(ttable, on_conflict='merge')
+
     def test_update_from_temporary(self):
         '''Tests updating of given columns from a temporary table'''
-        pass
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+        for column in ['id', 'a', 'b', 'c']:
+            table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        table.metadata.create_all(engine)
+        engine.execute(table.insert(), [{'id': i, 'a': i, 'b': i, 'c': i} for i in range(5)])
+
+        ttable = sqlalchemy.Table('temporary', MetaData(),
+                                  *[Column(c.name, c.type) for c in table.columns])
+        ttable.create(bind=engine)
+        engine.execute(ttable.insert(), [{'id': 0, 'a': 0, 'b': 0, 'c': 9},
+                                         {'id': 1, 'a': 7, 'b': 7, 'c': 9},
+                                         {'id': 2, 'a': 2, 'b': None, 'c': 9},
+                                         {'id': 3, 'a': 3, 'b': 3, 'c': 9}])
+
+        self.assertEqual(table.update_from_temporary(ttable, ['a', 'b']), (2, 3))
+        self.assertEqual(engine.execute(select([table]).order_by(table.c.id)).fetchall(),
+                         [(0, 0, 0, 0), (1, 7, 7, 1), (2, 2, None, 2), (3, 3, 3, 3), (4, 4, 4, 4)])
+        self.assertEqual(table.update_from_temporary(ttable, ['a', 'b']), (0, 0))
+
+    def test_transfer_data_batched(self):
+        '''Interrupted transfers must be resumed from their checkpoint'''
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+        for column in ['id', 'nome']:
+            table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        table.metadata.create_all(engine)
+        engine.execute(table.insert(), [{'id': i, 'nome': i * 10} for i in range(10)])
+        engine.execute(table._mapping_table.insert(), [{'target_name': 'NOME', 'name': 'nome',
+                                                        'type': 'INTEGER'}])
+        transfer_list = [{'name': 'nome', 'new_name': 'nome_novo', 'new_type': 'VARCHAR(10)'}]
+        backup = table._get_transfer_backup(transfer_list)
+
+        redefine_column = table.redefine_column
+        table.redefine_column = MagicMock(side_effect=base.DatabaseError('Interrupted'))
+        with self.assertRaises(base.DatabaseError):
+            table.transfer_data_batched(transfer_list, batch_size=3)
+        checkpoint = table.get_transfer_checkpoint()
+        self.assertEqual(checkpoint['stage'], 'redefine')
+        self.assertEqual(checkpoint['transfers'], transfer_list)
+        self.assertEqual(len(engine.execute(select([backup])).fetchall()), 10)
+        with self.assertRaises(base.DatabaseError):
+            table.transfer_data_batched(transfer_list, batch_size=3)
+
+        table.redefine_column = redefine_column
+        statements = []
+        sqlalchemy.event.listen(engine, 'before_execute',
+                                lambda *args: statements.append(str(args[1])))
+        table.resume_transfer(batch_size=3)
+        self.assertFalse([s for s in statements if 'OFFSET' in s.upper()])
+        self.assertIsNone(table.get_transfer_checkpoint())
+        self.assertFalse(backup.exists(bind=engine))
+        self.assertEqual(engine.execute(text('select id, nome_novo from {} order by id'
+                                             .format(self.name))).fetchall(),
+                         [(i, str(i * 10)) for i in range(10)])
+        self.assertEqual(engine.execute(select([table._mapping_table.c.name])).fetchall(),
+                         [('nome_novo',)])
+
+    def test_keys_after(self):
+        '''Composite keys must be compared in the order of their columns'''
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = sqlalchemy.Table('keys', MetaData(), Column('a', Integer, primary_key=True),
+                                 Column('b', Integer, primary_key=True))
+        table.create(bind=engine)
+        engine.execute(table.insert(), [{'a': a, 'b': b} for a in range(3) for b in range(3)])
+
+        query = select([table]).where(database_table.keys_after([table.c.a, table.c.b], [1, 1]))
+        self.assertEqual(engine.execute(query.order_by(table.c.a, table.c.b)).fetchall(),
+                         [(1, 2), (2, 0), (2, 1), (2, 2)])
+        query = select([table]).where(database_table.keys_after([table.c.a, table.c.b], None))
+        self.assertEqual(len(engine.execute(query).fetchall()), 9)
+
+    def test_delete_year(self):
+        '''Only the rows of the year must be deleted'''
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+        table.append_column(Column('id', Integer, primary_key=True))
+        table.metadata.create_all(engine)
+        with self.assertRaises(base.DatabaseColumnError):
+            table.delete_year(2015)
+
+        table = database_table.DatabaseTable(self.name + '_ano', MetaData(bind=engine))
+        for column in ['id', 'ano_censo']:
+            table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        table.metadata.create_all(engine)
+        engine.execute(table.insert(), [{'id': i, 'ano_censo': 2015 + i % 2} for i in range(5)])
+
+        self.assertEqual(table.delete_year(2015), 3)
+        self.assertEqual(engine.execute(select([table.c.id])).fetchall(), [(1,), (3,)])
+
+    def test_update_from_temporary_year(self):
+        '''Only rows of the given year must be matched'''
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = database_table.DatabaseTable(self.name, MetaData(bind=engine))
+        for column in ['id', 'ano_censo', 'a']:
+            table.append_column(Column(column, Integer, primary_key=column == 'id'))
+        table.metadata.create_all(engine)
+        engine.execute(table.insert(), [{'id': i, 'ano_censo': 2015 + i % 2, 'a': 0}
+                                        for i in range(4)])
+
+        ttable = sqlalchemy.Table('temporary', MetaData(), Column('id', Integer),
+                                  Column('a', Integer))
+        ttable.create(bind=engine)
+        engine.execute(ttable.insert(), [{'id': i, 'a': 1} for i in range(4)])
+
+        self.assertEqual(table.update_from_temporary(ttable, ['a'], year=2016), (2, 2))
+        self.assertEqual(engine.execute(select([table.c.a]).order_by(table.c.id)).fetchall(),
+                         [(0,), (1,), (0,), (1,)])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Describes tests for the database.protocol module, concerning Protocol lookups'''
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import patch
+
+import database.base as base
+import database.protocol as protocol
+
+# Disabled warning for access to protected member
+# pylint: disable=W0212
+
+PROTOCOL_CSV = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015,2016
+ANO,ano,Ano,0,ano_censo,INT,NU_ANO,NU_ANO_CENSO
+COR,cor,Cor/Raça,0,cor_raca_id,TINYINT,TP_COR_RACA,TP_COR_RACA
+RACA,raca,Raça,0,raca_id,TINYINT,TP_COR_RACA,
+TMP,tmp,Temporária,1,tmp_col,INT,TP_TMP,TP_TMP
+ESC,esc,Escola,0,escola_nome,VARCHAR(64),~escola.nome,~escola.nome
+IDADE,idade,Idade,0,idade,TINYINT,"~CASE WHEN ""NU_IDADE"" > 0 THEN ""NU_IDADE"" END",NU_IDADE
+'''
+
+
+class ProtocolTest(unittest.TestCase):
+    '''Test case for Protocol class'''
+    def setUp(self):
+        '''Loads a small protocol from memory'''
+        self.protocol = protocol.Protocol(StringIO(PROTOCOL_CSV))
+
+    def test_target_from_original(self):
+        '''Tests the lookup of targets from original columns'''
+        self.assertEqual(self.protocol.target_from_original('NU_ANO', '2015'), 'ANO')
+        self.assertEqual(self.protocol.target_from_original('NU_ANO_CENSO', '2016'), 'ANO')
+        self.assertIsNone(self.protocol.target_from_original('NU_ANO', '2016'))
+
+    def test_resolve_duplicates(self):
+        '''Two targets mapped to the same original must become a denormalization of the first'''
+        self.assertEqual(self.protocol.target_from_original('TP_COR_RACA', '2015'), 'COR')
+        self.assertEqual(self.protocol.original_from_target('RACA', '2015'), '~cor_raca_id')
+        self.assertEqual(self.protocol.target_from_original('~cor_raca_id', '2015'), 'RACA')
+        self.assertEqual(self.protocol._dataframe['2015'][2], '~cor_raca_id')
+
+    def test_year_plan_duplicates(self):
+        '''Duplicates nobody looks up must not fail the plan of the year'''
+        csv = PROTOCOL_CSV + '''BROKEN,broken,Quebrada,0,,,NU_BROKEN,
+OTHER,other,Outra,0,other,INT,NU_BROKEN,
+DOBRO,dobro,Dobro,0,dobro,INT,~ANO * 2,
+DOBRO2,dobro2,Dobro,0,dobro2,INT,~ANO * 2,
+'''
+        duplicated = protocol.Protocol(StringIO(csv))
+        plan = duplicated.year_plan('2015')
+        self.assertEqual(duplicated.original_from_target('DOBRO2', '2015'), '~ANO * 2')
+        self.assertEqual(plan.derivative_targets, ['RACA', 'IDADE', 'DOBRO', 'DOBRO2'])
+        self.assertEqual(plan.get_dbcolumns(['NU_ANO']), ['ano_censo'])
+        with self.assertRaises(base.InvalidTargetError):
+            plan.get_dbcolumns(['NU_ANO', 'NU_BROKEN'])
+
+    def test_without_temporary_column(self):
+        '''Protocols without the temporary column must still be planned'''
+        folder = os.path.join(os.path.dirname(__file__), '..', 'mapping_protocols')
+        for file_name, year in [('example_mapping_protocol.csv', '2016'),
+                                ('empty_map_protocol.csv', '2018')]:
+            plain = protocol.Protocol()
+            plain.load_csv(os.path.join(folder, file_name))
+            plain.year_plan(year)
+            self.assertEqual(plain.get_temporary_columns(year), [])
+
+    def test_dbcolumn_lookups(self):
+        '''Tests the translations between targets and dbcolumns'''
+        self.assertEqual(self.protocol.dbcolumn_from_target('COR'), ['cor_raca_id', 'TINYINT'])
+        self.assertEqual(self.protocol.target_from_dbcolumn('raca_id'), 'RACA')
+        self.assertIsNone(self.protocol.target_from_dbcolumn('missing'))
+        with self.assertRaises(base.InvalidTargetError):
+            self.protocol.dbcolumn_from_target('MISSING')
+
+    def test_duplicate_dbcolumn(self):
+        '''A dbcolumn repeated in the protocol must raise DuplicateColumnNameError'''
+        duplicated = PROTOCOL_CSV + 'DUP,dup,Duplicada,0,raca_id,INT,TP_DUP,TP_DUP\n'
+        duplicated = protocol.Protocol(StringIO(duplicated))
+        with self.assertRaises(base.DuplicateColumnNameError):
+            duplicated.target_from_dbcolumn('raca_id')
+
+    def test_get_comment(self):
+        '''Temporary columns have no comment'''
+        self.assertEqual(self.protocol.get_comment('COR'), 'Cor/Raça')
+        with self.assertRaises(base.InvalidTargetError):
+            self.protocol.get_comment('TMP')
+
+    def test_year_plan(self):
+        '''Tests the per year mapping plan'''
+        plan = self.protocol.year_plan('2015')
+        self.assertIs(plan, self.protocol.year_plan('2015'))
+        self.assertEqual(plan.get_dbcolumns(['NU_ANO', 'TP_COR_RACA', 'NU_IDADE']),
+                         ['ano_censo', 'cor_raca_id', 'NU_IDADE'])
+        self.assertEqual(plan.get_unmapped(['NU_ANO', 'NU_IDADE']), ['NU_IDADE'])
+        self.assertEqual(plan.get_used(['NU_ANO', 'NU_IDADE', 'TP_UNUSED']),
+                         ['NU_ANO', 'NU_IDADE'])
+        self.assertEqual(plan.derivative_targets, ['RACA', 'IDADE'])
+        self.assertEqual(plan.denormalization_targets, ['ESC'])
+        self.assertEqual(self.protocol.get_temporary_columns('2015'),
+                         [['tmp_col', 'INT', 'TP_TMP']])
+        self.assertIn(['idade', 'TINYINT'], plan.table_columns)
+
+        plan = self.protocol.year_plan('2016')
+        self.assertEqual(plan.derivative_targets, [])
+        self.assertEqual(plan.get_dbcolumns(['NU_IDADE']), ['idade'])
+
+    def test_remap_from_protocol(self):
+        '''Targets are renamed, dropped and added according to another protocol'''
+        new_csv = '''Var.Lab,Rot.Padrão,Novo Rótulo,Coluna temporária,Nome Banco,Tipo de Dado,2015,2016
+ANO,ano,Ano,0,ano_censo,INT,NU_ANO,NU_ANO_NOVO
+CORRACA,cor,Cor/Raça,0,cor_raca_id,TINYINT,TP_COR_RACA,TP_COR_RACA
+NOVA,nova,Nova,0,nova,INT,TP_NOVA,TP_NOVA
+'''
+        new_protocol = protocol.Protocol(StringIO(new_csv))
+        self.protocol.remap_from_protocol(new_protocol, ['2016'], '2015')
+
+        self.assertEqual(self.protocol.get_targets(), ['ANO', 'CORRACA', 'NOVA'])
+        self.assertEqual(self.protocol.original_from_target('ANO', '2016'), 'NU_ANO_NOVO')
+        self.assertEqual(self.protocol.original_from_target('NOVA', '2015'), 'TP_NOVA')
+        self.assertEqual(self.protocol.target_from_original('TP_COR_RACA', '2015'), 'CORRACA')
+
+    def test_remap_from_protocol_collision(self):
+        '''A target renamed to an existing target is dropped, before or after it'''
+        header = PROTOCOL_CSV.splitlines()[0].replace(',2016', '\n')
+        rows = ['A,a,A,0,a,INT,NU_X\n', 'B,b,B,0,b,INT,NU_Y\n']
+        new_protocol = protocol.Protocol(StringIO(header + 'B,b,B,0,b,INT,NU_X\n'))
+        for csv in [header + rows[0] + rows[1], header + rows[1] + rows[0]]:
+            old_protocol = protocol.Protocol(StringIO(csv))
+            old_protocol.remap_from_protocol(new_protocol, [], '2015')
+            self.assertEqual(old_protocol.get_targets(), ['B'])
+            self.assertEqual(old_protocol.original_from_target('B', '2015'), 'NU_Y')
+
+    def test_compiled_cache(self):
+        '''A protocol loaded from a path is cached and the cache is dropped when the csv changes'''
+        with tempfile.TemporaryDirectory() as directory:
+            protocol_path = os.path.join(directory, 'test.csv')
+            with open(protocol_path, 'w') as protocol_file:
+                protocol_file.write(PROTOCOL_CSV)
+
+            protocol.Protocol(protocol_path)
+            self.assertTrue(os.path.isfile(protocol.get_cache_path(protocol_path)))
+
+            with patch('database.protocol.Protocol._read_csv') as mocked_read_csv:
+                cached = protocol.Protocol(protocol_path)
+                mocked_read_csv.assert_not_called()
+            self.assertEqual(cached.target_from_original('NU_ANO', '2015'), 'ANO')
+
+            # A warm load must not import pandas
+            script = ('import sys, database.protocol as p; p.Protocol({!r}); '
+                      'print("pandas" in sys.modules)')
+            result = subprocess.run([sys.executable, '-c', script.format(protocol_path)],
+                                    cwd=os.path.join(os.path.dirname(__file__), '..'),
+                                    stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            self.assertEqual(result.stdout.strip(), 'False')
+
+            with open(protocol_path, 'a') as protocol_file:
+                protocol_file.write('NEW,new,Nova,0,nova,INT,TP_NOVA,TP_NOVA\n')
+            reloaded = protocol.Protocol(protocol_path)
+            self.assertEqual(reloaded.target_from_original('TP_NOVA', '2015'), 'NEW')
+
+if __name__ == '__main__':
+    unittest.main()
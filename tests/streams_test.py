@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Describes tests for the database.streams module, concerning compressed inputs'''
+import gzip
+import os
+import tempfile
+import unittest
+import zipfile
+
+import database.streams as streams
+
+DATA = b'NU_ANO;CO_ENTIDADE\n' + b''.join(b'2015;%d\n' % i for i in range(1000))
+
+
+class StreamsTest(unittest.TestCase):
+    '''Test case for input streams'''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_open_input(self):
+        '''Compressed files are decompressed, and the largest file of archives is read'''
+        gz_name = os.path.join(self.directory.name, 'data.csv.gz')
+        with gzip.open(gz_name, 'wb') as gz_file:
+            gz_file.write(DATA)
+        zip_name = os.path.join(self.directory.name, 'data.zip')
+        with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('LEIA-ME.txt', b'readme')
+            zip_file.writestr('DADOS/data.csv', DATA)
+        csv_name = os.path.join(self.directory.name, 'data.csv')
+        with open(csv_name, 'wb') as csv_file:
+            csv_file.write(DATA)
+
+        self.assertTrue(streams.is_compressed(gz_name))
+        self.assertTrue(streams.is_compressed(zip_name))
+        self.assertFalse(streams.is_compressed(csv_name))
+        for file_name in [gz_name, zip_name, csv_name]:
+            with streams.open_input(file_name) as input_file:
+                self.assertEqual(input_file.readline(), b'NU_ANO;CO_ENTIDADE\n')
+            self.assertEqual(b''.join(streams.iterate_input(file_name, 100)), DATA)
+
+    def test_sample_lines(self):
+        '''Plain files are sampled across the whole file, compressed files from the start'''
+        csv_name = os.path.join(self.directory.name, 'data.csv')
+        with open(csv_name, 'wb') as csv_file:
+            csv_file.write(DATA)
+        gz_name = os.path.join(self.directory.name, 'data.csv.gz')
+        with gzip.open(gz_name, 'wb') as gz_file:
+            gz_file.write(DATA)
+
+        lines = streams.sample_lines(csv_name, 100)
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(lines[0], b'2015;0\n')
+        self.assertTrue(set(lines) <= set(DATA.splitlines(True)[1:]))
+        self.assertGreater(max(int(l.split(b';')[1]) for l in lines), 900)
+
+        self.assertEqual(streams.sample_lines(gz_name, 3), [b'2015;0\n', b'2015;1\n', b'2015;2\n'])
+        self.assertEqual(len(streams.sample_lines(csv_name, 5000)), 1000)
+
+    def test_fifo(self):
+        '''The named pipe is fed with the chunks, and removed afterwards'''
+        with streams.fifo([DATA[:10], DATA[10:]], 'data.csv') as fifo_name:
+            self.assertEqual(os.path.basename(fifo_name), 'data.csv')
+            with open(fifo_name, 'rb') as fifo_file:
+                self.assertEqual(fifo_file.read(), DATA)
+        self.assertFalse(os.path.exists(fifo_name))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Describes tests for the database.tabbed module, concerning fixed width decoding'''
+import csv
+import os
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+from random import choice, randint
+from unittest.mock import patch
+
+import numpy as np
+
+import database.streams as streams
+import database.tabbed as tabbed
+from database.database_table import copy_tabbed_to_csv
+
+RECORD_LENGTH = 60
+
+
+def gen_random_tabbed(file_name, records, alphabet='0123456789  ..ab;"'):
+    '''Writes a random tabbed file and returns its lines'''
+    lines = [''.join(choice(alphabet) for _ in range(RECORD_LENGTH)) for _ in range(records)]
+    with open(file_name, 'w') as tabbed_file:
+        tabbed_file.write('\n'.join(lines) + '\n')
+    return lines
+
+def gen_random_mappings():
+    '''Generates column mappings covering the records, with overlapping and empty columns'''
+    mappings = []
+    position = 1
+    while position <= RECORD_LENGTH:
+        length = randint(1, 8)
+        mappings.append([float(position), float(length)])
+        position += length
+    mappings.append([3.0, 10.0])
+    mappings.append([RECORD_LENGTH + 5.0, 2.0])
+    return mappings
+
+class CountingPool(ThreadPool):
+    '''Pool of threads counting the tasks submitted to it'''
+    submitted = 0
+
+    def apply_async(self, *args, **kwargs):
+        CountingPool.submitted += 1
+        return super().apply_async(*args, **kwargs)
+
+def decode_line(line, mappings):
+    '''Reference decoding of a single line'''
+    return [line[int(p0 - 1):int(p0 + pt - 1)].strip().strip('.') for p0, pt in mappings]
+
+
+class TabbedTest(unittest.TestCase):
+    '''Test case for the fixed width decoder'''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tabbed_name = os.path.join(self.directory.name, 'input.txt')
+        self.mappings = gen_random_mappings()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_iterate_columns(self):
+        '''Blocks of records must be decoded like each line would be'''
+        lines = gen_random_tabbed(self.tabbed_name, 250)
+        decoded = []
+        for columns in tabbed.iterate_columns(self.tabbed_name, self.mappings, 100):
+            decoded += [[v.decode() for v in row] for row in zip(*columns)]
+
+        self.assertEqual(decoded, [decode_line(line, self.mappings) for line in lines])
+
+    def test_variable_length(self):
+        '''Records with different lengths are decoded line by line'''
+        lines = gen_random_tabbed(self.tabbed_name, 250)
+        lines[180] = lines[180][:20]
+        with open(self.tabbed_name, 'w') as tabbed_file:
+            tabbed_file.write('\n'.join(lines))
+
+        decoded = []
+        for columns in tabbed.iterate_columns(self.tabbed_name, self.mappings, 100):
+            decoded += [[v.decode() for v in row] for row in zip(*columns)]
+
+        self.assertEqual(decoded, [decode_line(line, self.mappings) for line in lines])
+
+    def test_unicode_whitespace(self):
+        '''Values must be stripped as str.strip() strips them in the encoding of the file'''
+        text = ['\xa0 12\x85. ', '\x1f\xc9\xa0.  ', ' a\xa0b \u3000', '...\xa0\x1c  ']
+        for encoding in ['latin-1', 'utf-8']:
+            lines = [line.encode(encoding, 'replace') for line in text]
+            length = max(len(line) for line in lines)
+            lines = [line.ljust(length) for line in lines]
+            mappings = [[1.0, float(length)], [2.0, 3.0]]
+            expected = [[line[int(p0 - 1):int(p0 + pt - 1)].decode(encoding, 'surrogateescape')
+                         .strip().strip('.') for line in lines] for p0, pt in mappings]
+
+            layout = tabbed.TabbedLayout(mappings, length, encoding)
+            records = np.frombuffer(b''.join(lines), dtype=np.uint8).reshape(-1, length)
+            for columns in [layout.decode(records),
+                            tabbed.decode_lines(lines, layout.slices, encoding)]:
+                self.assertEqual([[v.decode(encoding, 'surrogateescape') for v in column]
+                                  for column in columns], expected)
+
+    def test_copy_tabbed_to_csv(self):
+        '''The csv must be readable by the csv module, quoted values included'''
+        for alphabet in ['0123456789  ..', '0123456789  ..ab;"']:
+            lines = gen_random_tabbed(self.tabbed_name, 250, alphabet)
+            csv_name = os.path.join(self.directory.name, 'output.csv')
+            names = ['c{}'.format(i) for i in range(len(self.mappings))]
+            copy_tabbed_to_csv(self.tabbed_name, self.mappings, 64, csv_name, names)
+
+            with open(csv_name, newline='') as csv_file:
+                rows = list(csv.reader(csv_file, delimiter=';'))
+            self.assertEqual(rows[0], names)
+            self.assertEqual(rows[1:], [decode_line(line, self.mappings) for line in lines])
+
+    def test_parallel_csv(self):
+        '''Ranges must be aligned to records and converted in the order of the file'''
+        gen_random_tabbed(self.tabbed_name, 250)
+        ranges = streams.split_ranges(self.tabbed_name, 1000)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.tabbed_name))
+        for start, end in ranges:
+            self.assertEqual(start % (RECORD_LENGTH + 1), 0)
+            self.assertEqual(end % (RECORD_LENGTH + 1), 0)
+
+        serial = b''.join(tabbed.iterate_csv(self.tabbed_name, self.mappings, 16))
+        parallel = b''.join(tabbed.iterate_csv_parallel(self.tabbed_name, self.mappings, 16, 2))
+        self.assertEqual(parallel, serial)
+
+    def test_parallel_csv_pending(self):
+        '''Workers must not convert more than max_pending ranges ahead of the consumer'''
+        gen_random_tabbed(self.tabbed_name, 250)
+        serial = b''.join(tabbed.iterate_csv(self.tabbed_name, self.mappings, 4))
+        chunks = []
+        with patch('database.tabbed.Pool', CountingPool):
+            for chunk in tabbed.iterate_csv_parallel(self.tabbed_name, self.mappings, 4, 2,
+                                                     max_pending=3):
+                self.assertLessEqual(CountingPool.submitted - len(chunks), 3)
+                chunks.append(chunk)
+        self.assertEqual(CountingPool.submitted, len(chunks))
+        self.assertEqual(b''.join(chunks), serial)
+
+    def test_csv_fifo(self):
+        '''The named pipe must be fed with the csv lines, and removed afterwards'''
+        gen_random_tabbed(self.tabbed_name, 250)
+        serial = b''.join(tabbed.iterate_csv(self.tabbed_name, self.mappings, 16))
+        with tabbed.csv_fifo(self.tabbed_name, self.mappings, 16) as fifo_name:
+            with open(fifo_name, 'rb') as fifo:
+                self.assertEqual(fifo.read(), serial)
+        self.assertFalse(os.path.exists(fifo_name))
+
+        with self.assertRaises(BrokenPipeError):
+            with tabbed.csv_fifo(self.tabbed_name, self.mappings, 16) as fifo_name:
+                pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Describes tests for the database.types module, concerning type inference'''
+import unittest
+
+import database.types as types
+
+
+class TypesTest(unittest.TestCase):
+    '''Test case for type inference of csv columns'''
+    def test_infer_type(self):
+        '''The narrowest type with room for larger values must be chosen'''
+        self.assertEqual(types.infer_type(['1', '', '63']), 'TINYINT')
+        self.assertEqual(types.infer_type(['1', '64']), 'SMALLINT')
+        self.assertEqual(types.infer_type(['-20000']), 'INT')
+        self.assertEqual(types.infer_type(['4100000000']), 'BIGINT')
+        self.assertEqual(types.infer_type(['1', '2.5']), 'DOUBLE')
+        self.assertEqual(types.infer_type(['2015-01-31']), 'DATE')
+
+    def test_infer_type_fallback(self):
+        '''Codes, mixed values and empty columns must remain strings'''
+        for values in [['007', '1'], ['1', 'a'], ['2,5'], [''], [], ['10' * 20],
+                       ['2015-02-30'], ['2015-13-01', '2015-01-01']]:
+            self.assertEqual(types.infer_type(values), 'VARCHAR(255)')
+        self.assertEqual(types.infer_type(['1', 'NA'], null='NA'), 'TINYINT')
+
+    def test_fits_type(self):
+        '''Values must fit the types chosen by infer_type, nulls fit any type'''
+        self.assertTrue(types.fits_type('007', 'TINYINT'))
+        self.assertFalse(types.fits_type('128', 'TINYINT'))
+        self.assertFalse(types.fits_type('1.5', 'INT'))
+        self.assertTrue(types.fits_type('1.5', 'DOUBLE'))
+        self.assertFalse(types.fits_type('2015-02-30', 'DATE'))
+        self.assertTrue(types.fits_type('NA', 'INT', null='NA'))
+        self.assertTrue(types.fits_type('a', 'VARCHAR(255)'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (C) 2016 Centro de Computacao Cientifica e Software Livre
+Departamento de Informatica - Universidade Federal do Parana - C3SL/UFPR
+
+This file is part of HOTMapper.
+
+HOTMapper is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HOTMapper is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HOTMapper.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+'''Describes tests for the database.uploads module, concerning client side COPY'''
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import database.uploads as uploads
+
+
+class UploadsTest(unittest.TestCase):
+    '''Test case for FileUploader'''
+    def setUp(self):
+        self.uploader = uploads.FileUploader(chunk_size=4)
+        self.upload = MagicMock()
+        self.upload.is_cancelled.return_value = False
+        self.writer = io.BytesIO()
+        self.writer.close = lambda: None
+        self.upload.binary_writer.return_value = self.writer
+
+    def test_skip_lines(self):
+        '''Lines may be split between chunks'''
+        chunks = [b'head', b'er\nfi', b'rst\nsecond\n', b'third\n']
+        self.assertEqual(b''.join(uploads.skip_lines(chunks, 0)), b''.join(chunks))
+        self.assertEqual(b''.join(uploads.skip_lines(chunks, 1)), b'first\nsecond\nthird\n')
+        self.assertEqual(b''.join(uploads.skip_lines(chunks, 3)), b'third\n')
+
+    def test_upload_file(self):
+        '''Files are read from disk, skipping the lines requested by the server'''
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'data.csv')
+            with open(file_name, 'wb') as data_file:
+                data_file.write(b'header\n1;2\n3;4\n')
+            self.uploader.add_file(file_name)
+            self.uploader.handle_upload(self.upload, file_name, True, 1)
+
+        self.assertEqual(self.writer.getvalue(), b'1;2\n3;4\n')
+        self.upload.send_error.assert_not_called()
+
+    def test_upload_stream(self):
+        '''Streams are sent once, and other files are refused'''
+        self.uploader.add_file('stream', [b'1;2\n', b'3;4\n'])
+        self.uploader.add_file('stream')
+        self.uploader.handle_upload(self.upload, 'stream', True, 0)
+        self.assertEqual(self.writer.getvalue(), b'1;2\n3;4\n')
+
+        self.uploader.handle_upload(self.upload, 'stream', True, 0)
+        self.uploader.handle_upload(self.upload, '/etc/passwd', True, 0)
+        self.assertEqual(self.upload.send_error.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()